@@ -8,15 +8,837 @@ from collections import OrderedDict
 import struct
 import urllib.request
 import zipfile
+import queue
+import threading
+import time
+import hashlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows, reflinks are skipped
+import json
+import http.server
+import contextlib
+import io
+import functools
+import concurrent.futures
+import zlib
+import re
+import asyncio
+import signal
+import sqlite3
+
+SKIPPED = object()  # Returned by a pipeline stage when the mod needs no further work
+FICLONE = 0x40049409  # Linux ioctl used for reflinks
+
+
+def read_inventory(path):
+    """
+    Server inventory file, one server home directory per line.  Blank lines and lines starting with # are ignored
+    :return: List of paths
+    """
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+
+def hash_file(path):
+    """
+    SHA1 a file in 1MB blocks
+    :return: Hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def scan_tree(root, previous=None):
+    """
+    Size, mtime and SHA1 of every file under root, keyed by relative path with forward slashes.
+    Files whose size and mtime match the previous scan reuse its hash instead of being read again.
+    :return: Dict of relative path to file details
+    """
+    previous = previous or {}
+    manifest = {}
+    for curdir, subdirs, files in os.walk(root):
+        for file in files:
+            path = os.path.join(curdir, file)
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            stat = os.stat(path)
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime}
+            old = previous.get(rel)
+            if old and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+                entry["sha1"] = old["sha1"]
+            else:
+                entry["sha1"] = hash_file(path)
+            manifest[rel] = entry
+    return manifest
+
+
+def scan_sizes(root):
+    """
+    Size of every file below root, without hashing them
+    :return: Dict of relative path to {"size": ...}
+    """
+    sizes = {}
+    for curdir, subdirs, files in os.walk(root):
+        for file in files:
+            path = os.path.join(curdir, file)
+            sizes[os.path.relpath(path, root).replace(os.sep, "/")] = {"size": os.path.getsize(path)}
+    return sizes
+
+
+def list_mod_dirs(mods_folder):
+    """
+    Names of the mod folders in a server's Mods folder
+    :return: List of mod IDs
+    """
+    if not os.path.isdir(mods_folder):
+        return []
+    # Skip staging folders left behind by an interrupted sync
+    return [d for d in next(os.walk(mods_folder))[1] if not d.startswith(".")]
+
+
+def staging_path(output_dir):
+    """
+    Hidden folder next to output_dir used to build a new copy before it is swapped in
+    :return: Path
+    """
+    return os.path.join(os.path.dirname(output_dir), "." + os.path.basename(output_dir) + ".staging")
+
+
+def reflink(src, dst):
+    """
+    Copy-on-write clone of src to dst on filesystems that support it (Btrfs, XFS).  Raises OSError if not supported
+    :return:
+    """
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def copy_file(src, dst, throttle=None):
+    """
+    Copy a file with its metadata like shutil.copy2, writing through the arkit.Throttle if one is given
+    :return:
+    """
+    if throttle is None:
+        shutil.copy2(src, dst)
+        return
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        for block in iter(lambda: s.read(1024 * 1024), b""):
+            d.write(block)
+            throttle.consume(len(block))
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src, dst, throttle=None):
+    """
+    Hard link src to dst, falling back to a reflink and then a copy when linking is not possible (e.g. across drives)
+    :return:
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            reflink(src, dst)
+        except OSError:
+            copy_file(src, dst, throttle)
+
+
+def lower_priority():
+    """
+    Drop to the lowest CPU priority and the lowest best effort I/O priority so installs on a live host leave the
+    disks and cores to the running servers.  Threads and SteamCMD processes started afterwards inherit both.
+    :return:
+    """
+    if not hasattr(os, "nice"):
+        print("[!] Lowering The Priority Is Not Supported On This Platform")
+        return
+
+    os.nice(19 - os.nice(0))
+    if sys.platform.startswith("linux") and shutil.which("ionice"):
+        subprocess.call(["ionice", "-c", "2", "-n", "7", "-p", str(os.getpid())])
+    print("[+] Running At Low CPU And I/O Priority")
+
+
+def old_path(output_dir):
+    """
+    Hidden folder next to output_dir that holds the replaced copy while swap_into_place runs
+    :return: Path
+    """
+    return os.path.join(os.path.dirname(output_dir), "." + os.path.basename(output_dir) + ".old")
+
+
+def restore_swapped(mods_folder):
+    """
+    Rename mod folders that an interrupted swap_into_place left as .<modid>.old back into place, so a crash
+    between its two renames does not leave the server without the mod until it is installed again.
+    :return: List of restored mod IDs
+    """
+    if not os.path.isdir(mods_folder):
+        return []
+    restored = []
+    for name in next(os.walk(mods_folder))[1]:
+        if name.startswith(".") and name.endswith(".old"):
+            modid = name[1:-4]
+            output_dir = os.path.join(mods_folder, modid)
+            if not os.path.isdir(output_dir):
+                os.rename(os.path.join(mods_folder, name), output_dir)
+                print("[!] Restored Mod {} Left Behind By An Interrupted Install".format(modid))
+                restored.append(modid)
+    return restored
+
+
+def swap_into_place(staging_dir, output_dir):
+    """
+    Replace output_dir with a fully built staging_dir using renames, so the server never sees a missing or half
+    copied folder for longer than two renames.
+    :return:
+    """
+    old_dir = old_path(output_dir)
+    if os.path.isdir(old_dir):
+        if os.path.isdir(output_dir):
+            shutil.rmtree(old_dir)
+        else:
+            # An earlier swap was interrupted between its renames, the old copy is the one the server has
+            os.rename(old_dir, output_dir)
+
+    if os.path.isdir(output_dir):
+        os.rename(output_dir, old_dir)
+    os.rename(staging_dir, output_dir)
+
+    if os.path.isdir(old_dir):
+        shutil.rmtree(old_dir)
+
+
+def sync_tree(source_dir, output_dir, throttle=None, installed=None):
+    """
+    Differential copy of source_dir to output_dir.
+    A staging folder is built next to output_dir where files that are identical (size and SHA1) in the existing
+    output are hard linked rather than copied, changed and new files are copied, and stale files are left out.
+    The staging folder is then swapped in with swap_into_place.  Copies are written through throttle if given.
+    installed is the manifest of output_dir from the last install (see scan_tree).  Existing files whose size and
+    mtime still match it are compared by its SHA1, so only the source side is read.
+    :return: Tuple of (copied, unchanged, deleted) file counts and the bytes copied
+    """
+    installed = installed or {}
+    staging_dir = staging_path(output_dir)
+    if os.path.isdir(staging_dir):
+        shutil.rmtree(staging_dir)
+
+    def existing_sha1(path, rel):
+        stat = os.stat(path)
+        entry = installed.get(rel.replace(os.sep, "/"))
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["sha1"]
+        return hash_file(path)
+
+    copied, unchanged, copied_bytes = 0, 0, 0
+    synced = set()
+    for curdir, subdirs, files in os.walk(source_dir):
+        rel_dir = os.path.relpath(curdir, source_dir)
+        os.makedirs(os.path.join(staging_dir, rel_dir), exist_ok=True)
+        for file in files:
+            rel = os.path.normpath(os.path.join(rel_dir, file))
+            src = os.path.join(source_dir, rel)
+            existing = os.path.join(output_dir, rel)
+            staged = os.path.join(staging_dir, rel)
+            synced.add(rel)
+
+            if os.path.isfile(existing) and os.path.getsize(existing) == os.path.getsize(src) and existing_sha1(existing, rel) == hash_file(src):
+                link_or_copy(existing, staged)
+                unchanged += 1
+            else:
+                copy_file(src, staged, throttle)
+                copied += 1
+                copied_bytes += os.path.getsize(staged)
+
+    deleted = 0
+    for curdir, subdirs, files in os.walk(output_dir):
+        for file in files:
+            if os.path.relpath(os.path.join(curdir, file), output_dir) not in synced:
+                deleted += 1
+
+    swap_into_place(staging_dir, output_dir)
+    return copied, unchanged, deleted, copied_bytes
+
+
+def parse_vdf(text):
+    """
+    Parse Valve's KeyValues text format as used by SteamCMD's .acf manifests
+    :return: OrderedDict
+    """
+    tokens = re.findall(r'"((?:[^"\\]|\\.)*)"|([{}])', text)
+    root = OrderedDict()
+    stack = [root]
+    key = None
+    for string, brace in tokens:
+        if brace == "{":
+            child = OrderedDict()
+            stack[-1][key] = child
+            stack.append(child)
+            key = None
+        elif brace == "}":
+            stack.pop()
+        elif key is None:
+            key = string
+        else:
+            stack[-1][key] = string
+            key = None
+    return root
+
+
+def dump_vdf(data, depth=0):
+    """
+    Write an OrderedDict back out in Valve's KeyValues text format
+    :return: String
+    """
+    lines = []
+    indent = "\t" * depth
+    for key, value in data.items():
+        if isinstance(value, dict):
+            lines.append('{}"{}"'.format(indent, key))
+            lines.append(indent + "{")
+            lines.append(dump_vdf(value, depth + 1))
+            lines.append(indent + "}")
+        else:
+            lines.append('{}"{}"\t\t"{}"'.format(indent, key, value))
+    return "\n".join(line for line in lines if line)
+
+
+class ModIndex():
+    """
+    SQLite index of the mods installed on one server: name, maps, modmeta.info keys, size and install time.
+    It is updated on every install so listings and queries are answered without reading the Mods folder.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.connect() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS mods (modid TEXT PRIMARY KEY, name TEXT, size INTEGER, files INTEGER, installed REAL);
+                CREATE TABLE IF NOT EXISTS maps (modid TEXT, map TEXT);
+                CREATE TABLE IF NOT EXISTS meta (modid TEXT, key TEXT, value TEXT);
+                CREATE INDEX IF NOT EXISTS maps_map ON maps (map COLLATE NOCASE);
+                CREATE INDEX IF NOT EXISTS maps_modid ON maps (modid);
+                CREATE INDEX IF NOT EXISTS meta_modid ON meta (modid);
+            """)
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        Connection committed on success, one per call so the index can be used from any pipeline thread
+        """
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def update(self, modid, name, maps, meta, size, files, installed=None):
+        with self.connect() as db:
+            self.delete(modid, db)
+            db.execute("INSERT INTO mods VALUES (?, ?, ?, ?, ?)", (modid, name, size, files, installed or time.time()))
+            db.executemany("INSERT INTO maps VALUES (?, ?)", [(modid, m) for m in maps])
+            db.executemany("INSERT INTO meta VALUES (?, ?, ?)", [(modid, k, v) for k, v in meta.items()])
+
+    def delete(self, modid=None, db=None):
+        """
+        Remove one mod, or every mod if no mod ID is given
+        :return:
+        """
+        if db is None:
+            with self.connect() as db:
+                return self.delete(modid, db)
+        for table in ("mods", "maps", "meta"):
+            if modid is None:
+                db.execute("DELETE FROM " + table)
+            else:
+                db.execute("DELETE FROM " + table + " WHERE modid = ?", (modid,))
+
+    def mods(self, where="", params=(), order="modid", limit=None):
+        """
+        Query the indexed mods
+        :return: List of dicts with modid, name, size, files, installed and maps
+        """
+        query = "SELECT modid, name, size, files, installed FROM mods " + where + " ORDER BY " + order
+        if limit:
+            query += " LIMIT " + str(int(limit))
+        with self.connect() as db:
+            rows = [dict(zip(("modid", "name", "size", "files", "installed"), row)) for row in db.execute(query, params)]
+            for row in rows:
+                row["maps"] = [m for m, in db.execute("SELECT map FROM maps WHERE modid = ? ORDER BY rowid", (row["modid"],))]
+        return rows
+
+    def which_map(self, map_name):
+        return self.mods("WHERE modid IN (SELECT modid FROM maps WHERE map = ? COLLATE NOCASE)", (map_name,))
+
+    def largest(self, count):
+        return self.mods(order="size DESC", limit=count)
+
+
+class Metrics():
+    """
+    Per mod, per phase instrumentation.
+    Every measured phase becomes an event with its duration, bytes read and written, file count and outcome.
+    Events are appended to a JSON lines log as they happen and/or written to a Prometheus textfile collector
+    file on close, one series per mod and phase.  summary() prints a table of the totals per phase.
+    """
+
+    def __init__(self, jsonl_path=None, prom_path=None):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.events = []
+        self.series = OrderedDict()  # (mod, phase) to the totals last written to prom_path
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Stack of the events being measured on this thread
+
+    @contextlib.contextmanager
+    def measure(self, modid, phase, start=None, seconds=None):
+        """
+        Measure a block as a phase.  start backdates the phase, for work that was awaited before the block, and
+        seconds replaces the measured duration, for a mod's share of work done for several mods at once
+        """
+        start = start or time.time()
+        event = OrderedDict([("time", start), ("mod", modid), ("phase", phase), ("seconds", 0.0),
+                             ("bytes_read", 0), ("bytes_written", 0), ("files", 0), ("outcome", "ok")])
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(event)
+        try:
+            yield event
+        except Exception:
+            event["outcome"] = "error"
+            raise
+        finally:
+            stack.pop()
+            event["seconds"] = round(time.time() - start if seconds is None else seconds, 4)
+            self.record(event)
+
+    def count(self, bytes_read=0, bytes_written=0, files=0):
+        """
+        Add to the counters of the innermost phase being measured on this thread
+        :return:
+        """
+        stack = self.local.__dict__.get("stack")
+        if stack:
+            stack[-1]["bytes_read"] += bytes_read
+            stack[-1]["bytes_written"] += bytes_written
+            stack[-1]["files"] += files
+
+    def record(self, event):
+        with self.lock:
+            self.events.append(event)
+            if self.jsonl_path:
+                with open(self.jsonl_path, "a") as f:
+                    f.write(json.dumps(event) + "\n")
+
+    def close(self):
+        """
+        Write the Prometheus file.  The events of one mod and phase are added up into a single series, with the
+        outcome of the latest one, since the collector rejects a file with duplicate series.  A series stays in the
+        file until a later close has new events for its mod and phase
+        :return:
+        """
+        if not self.prom_path:
+            return
+
+        totals = OrderedDict()
+        for event in self.events:
+            key = (event["mod"] or "", event["phase"])
+            total = totals.setdefault(key, OrderedDict([("seconds", 0.0), ("bytes_read", 0), ("bytes_written", 0), ("files", 0)]))
+            total["seconds"] = round(total["seconds"] + event["seconds"], 4)
+            total["bytes_read"] += event["bytes_read"]
+            total["bytes_written"] += event["bytes_written"]
+            total["files"] += event["files"]
+            total["outcome"] = event["outcome"]
+        self.series.update(totals)
+
+        lines = []
+        metrics = [("seconds", "ark_mod_phase_duration_seconds", "Time spent in the phase"),
+                   ("bytes_read", "ark_mod_phase_bytes_read", "Bytes read during the phase"),
+                   ("bytes_written", "ark_mod_phase_bytes_written", "Bytes written during the phase"),
+                   ("files", "ark_mod_phase_files", "Files handled during the phase")]
+        for key, name, help_text in metrics + [("outcome", "ark_mod_phase_success", "1 if the phase succeeded")]:
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} gauge".format(name))
+            for (modid, phase), total in self.series.items():
+                value = int(total["outcome"] == "ok") if key == "outcome" else total[key]
+                lines.append('{}{{mod="{}",phase="{}"}} {}'.format(name, modid, phase, value))
+
+        # Write then rename so the collector never reads a partial file
+        with open(self.prom_path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.prom_path + ".tmp", self.prom_path)
+
+    def reset(self):
+        """
+        Forget the events recorded so far, the series already written are kept
+        :return:
+        """
+        with self.lock:
+            self.events = []
+
+    def summary(self):
+        if not self.events:
+            return
+
+        totals = OrderedDict()
+        for event in self.events:
+            total = totals.setdefault(event["phase"], OrderedDict([("count", 0), ("seconds", 0.0), ("bytes_read", 0), ("bytes_written", 0), ("files", 0), ("failed", 0)]))
+            total["count"] += 1
+            total["seconds"] += event["seconds"]
+            total["bytes_read"] += event["bytes_read"]
+            total["bytes_written"] += event["bytes_written"]
+            total["files"] += event["files"]
+            total["failed"] += event["outcome"] != "ok"
+
+        print("[+] Phase Metrics:")
+        print("    {:<16}{:>7}{:>11}{:>12}{:>12}{:>8}{:>8}".format("Phase", "Count", "Seconds", "MB Read", "MB Written", "Files", "Failed"))
+        for phase, total in totals.items():
+            print("    {:<16}{:>7}{:>11.2f}{:>12.1f}{:>12.1f}{:>8}{:>8}".format(phase, total["count"], total["seconds"], total["bytes_read"] / 1048576, total["bytes_written"] / 1048576, total["files"], total["failed"]))
+
+
+def instrumented(phase):
+    """
+    Measure an ArkModDownloader method as a phase in self.metrics.
+    The first argument is taken as the mod ID, and a False return value marks the phase as failed.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            modid = args[0] if args else None
+            with self.metrics.measure(modid, phase) as event:
+                result = func(self, *args, **kwargs)
+                if result is False:
+                    event["outcome"] = "failed"
+                return result
+        return wrapper
+    return decorator
+
+
+class SteamCmdRunner():
+    """
+    Runs SteamCMD with asyncio, following its output as it is written.
+    Each run downloads a batch of mods in one SteamCMD process.  Progress lines are summarised, success and failure
+    lines are parsed per item and SteamCMD is killed once an item takes longer than item_timeout.  Items that failed
+    for a reason other than a permanent one (for example File Not Found) are retried in a new process, waiting
+    backoff, then twice as long, and so on between attempts.
+    """
+
+    PERMANENT_ERRORS = ("File Not Found", "Access Denied", "Invalid Parameter", "No Subscription")
+
+    def __init__(self, steamcmd, item_timeout=1800, retries=3, backoff=15):
+        self.steamcmd = steamcmd
+        self.item_timeout = item_timeout  # Seconds a single item may take before SteamCMD is considered hung
+        self.retries = retries
+        self.backoff = backoff
+
+    async def run(self, modids):
+        """
+        One SteamCMD process for a batch of mods
+        :return: Dict of mod ID to (Bool, reason)
+        """
+        args = [self.steamcmd, "+login", "anonymous"]
+        for modid in modids:
+            args += ["+workshop_download_item", "346110", modid]
+        args.append("+quit")
+
+        process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT, limit=1024 * 1024, **self.group())
+        results = {}
+        state = {"progress": None}
+        deadline = time.time() + self.item_timeout
+        try:
+            while True:
+                try:
+                    raw = await asyncio.wait_for(process.stdout.readline(), max(0, deadline - time.time()))
+                except asyncio.TimeoutError:
+                    current = next((modid for modid in modids if modid not in results), None)
+                    print("[x] SteamCMD Timed Out Downloading Mod {} After {}s".format(current, self.item_timeout))
+                    break
+                if not raw:
+                    break
+
+                if self.follow(raw.decode("utf-8", "replace").rstrip(), modids, results, state):
+                    deadline = time.time() + self.item_timeout
+        finally:
+            if process.returncode is None:
+                self.kill(process)
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                print("[!] SteamCMD (PID {}) Did Not Exit After Being Killed".format(process.pid))
+
+        for modid in modids:
+            if modid not in results:
+                results[modid] = (False, "SteamCMD exited with {}".format(process.returncode))
+        return results
+
+    def follow(self, line, modids, results, state):
+        """
+        Print a line of SteamCMD output, summarising progress lines, and record the result of an item it reports
+        :return: True if the line finished an item
+        """
+        match = re.search(r"progress: ([\d.]+) \((\d+) / (\d+)\)", line)
+        if match:
+            # Items are downloaded in the order they were given
+            current = next((modid for modid in modids if modid not in results), None)
+            percent = int(float(match.group(1)))
+            if percent // 10 != state["progress"]:
+                state["progress"] = percent // 10
+                print("[+] Downloading Mod {}: {}% ({:.1f} / {:.1f} MB)".format(current, percent, int(match.group(2)) / 1048576, int(match.group(3)) / 1048576))
+            return False
+
+        print(line)
+        match = re.search(r"(Success)\. Downloaded item (\d+)|ERROR! Download item (\d+) failed \(([^)]*)\)", line)
+        if match:
+            results[match.group(2) or match.group(3)] = (bool(match.group(1)), match.group(4))
+            state["progress"] = None
+            return True
+        return False
+
+    @staticmethod
+    def group():
+        """
+        SteamCMD runs in a process group of its own so a hung run can be killed along with any children it started
+        :return: Dict of keyword arguments for starting the process
+        """
+        if os.name == "nt":
+            return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        return {"start_new_session": True}
+
+    @staticmethod
+    def kill(process):
+        """
+        Kill SteamCMD and every process in its group
+        :return:
+        """
+        try:
+            if os.name == "nt":
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except (OSError, subprocess.SubprocessError):
+            pass
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+    async def download(self, modids):
+        """
+        Download a batch of mods, retrying transient failures
+        :return: Dict of mod ID to Bool
+        """
+        downloaded = {}
+        pending = list(modids)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                print("[!] Retrying Mods {} In {}s (Attempt {} Of {})".format(", ".join(pending), delay, attempt + 1, self.retries + 1))
+                await asyncio.sleep(delay)
+
+            results = await self.run(pending)
+            pending = []
+            for modid, (ok, reason) in results.items():
+                downloaded[modid] = ok
+                if not ok:
+                    if reason in self.PERMANENT_ERRORS:
+                        print("[x] Mod {} Failed To Download: {}".format(modid, reason))
+                    else:
+                        pending.append(modid)
+            if not pending:
+                break
+
+        return downloaded
+
+
+class SteamCmdSession(SteamCmdRunner):
+    """
+    A SteamCMD process that stays logged in between downloads.
+    Commands are written to its console on stdin and its output is followed until every requested item has
+    reported success or failure, so SteamCMD's startup, self update check and login only happen once.  Items get the
+    same deadline, and failures the same retries, as with SteamCmdRunner.  A session that timed out is killed and
+    started again for the next attempt.
+    """
+
+    def __init__(self, steamcmd, item_timeout=1800, retries=3, backoff=15):
+        super().__init__(steamcmd, item_timeout, retries, backoff)
+        self.process = None
+        self.lines = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        print("[+] Starting SteamCMD Session")
+        self.process = subprocess.Popen([self.steamcmd, "+login", "anonymous"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1, **self.group())
+        self.lines = queue.Queue()
+        threading.Thread(target=self.read_output, args=(self.process, self.lines), daemon=True).start()
+
+    @staticmethod
+    def read_output(process, lines):
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    async def run(self, modids):
+        """
+        One attempt at a batch of mods through the running session, see run_console
+        :return: Dict of mod ID to (Bool, reason)
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.run_console, modids)
+
+    def run_console(self, modids):
+        """
+        Download mods through the running session, starting (or restarting) SteamCMD if needed
+        :return: Dict of mod ID to (Bool, reason)
+        """
+        with self.lock:
+            if not self.alive():
+                self.start()
+
+            try:
+                for modid in modids:
+                    self.process.stdin.write("workshop_download_item 346110 {}\n".format(modid))
+                self.process.stdin.flush()
+            except OSError as e:
+                print("[x] SteamCMD Session Stopped Taking Commands: {}".format(e))
+                self.kill(self.process)
+                return {modid: (False, "SteamCMD session ended") for modid in modids}
+
+            results = {}
+            state = {"progress": None}
+            deadline = time.time() + self.item_timeout
+            while any(modid not in results for modid in modids):
+                try:
+                    line = self.lines.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    current = next((modid for modid in modids if modid not in results), None)
+                    print("[x] SteamCMD Timed Out Downloading Mod {} After {}s.  Restarting The Session".format(current, self.item_timeout))
+                    self.kill(self.process)
+                    break
+                if line is None:
+                    print("[x] SteamCMD Session Exited")
+                    break
+                if self.follow(line.rstrip(), modids, results, state):
+                    deadline = time.time() + self.item_timeout
+
+            for modid in modids:
+                if modid not in results:
+                    results[modid] = (False, "SteamCMD session ended")
+            return results
+
+    def close(self):
+        if self.alive():
+            try:
+                self.process.stdin.write("quit\n")
+                self.process.stdin.flush()
+                self.process.wait(10)
+            except (OSError, subprocess.TimeoutExpired):
+                self.kill(self.process)
+
+
+class JobRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Local job queue API used by daemon mode
+        POST /jobs         {"modids": [...], "update": false, "workingdir": [...]}  Queue an install or update, for
+                           the given servers or every server if workingdir is left out
+        GET  /jobs         Every job
+        GET  /jobs/<id>    One job
+    """
+
+    def send_json(self, status, body):
+        raw = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        downloader = self.server.downloader
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            self.send_json(200, downloader.list_jobs())
+        elif len(parts) == 2 and parts[0] == "jobs" and downloader.get_job(parts[1]):
+            self.send_json(200, downloader.get_job(parts[1]))
+        else:
+            self.send_json(404, {"error": "Not Found"})
+
+    def do_POST(self):
+        if self.path.strip("/") != "jobs":
+            self.send_json(404, {"error": "Not Found"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            modids = [str(modid) for modid in body.get("modids") or []]
+            working_dirs = body.get("workingdir") or []
+            working_dirs = [working_dirs] if isinstance(working_dirs, str) else [str(d) for d in working_dirs]
+        except (ValueError, TypeError, AttributeError):
+            self.send_json(400, {"error": "Body must be JSON like {\"modids\": [...], \"update\": false, \"workingdir\": [...]}"})
+            return
+        if not modids and not body.get("update"):
+            self.send_json(400, {"error": "No Mod IDs Provided and Update Not Selected"})
+            return
+        servers = self.server.downloader.find_servers(working_dirs)
+        if None in servers:
+            unknown = [d for d, server in zip(working_dirs, servers) if server is None]
+            self.send_json(400, {"error": "Unknown Servers: " + ", ".join(unknown)})
+            return
+        self.send_json(202, self.server.downloader.submit_job(modids, bool(body.get("update")), servers))
+
+    def log_message(self, format, *args):
+        print("[+] API: " + format % args)
+
 
 class ArkModDownloader():
 
-    def __init__(self, steamcmd, modids, working_dir, mod_update, modname, preserve=False):
+    def __init__(self, steamcmd, modids, working_dir, mod_update, modname, preserve=False, workers=4, download_batch_size=1, clean_mods=False, direct=False, verify=False, repair=False, metrics_jsonl=None, metrics_prom=None, inventory=None, store_dir=None, chunk_cache=None, chunk_cache_size=2048, list_mods=False, which_map=None, largest=None, reindex=False, concurrency=1, timeout=1800, retries=3, max_write=None, nice=False, backend=None):
+
+        self.metrics = Metrics(metrics_jsonl, metrics_prom)  # Per phase timings, see --metrics-jsonl and --metrics-prom
+
+        # Several servers can be given as a list of working directories and/or an inventory file
+        self.working_dirs = [working_dir] if isinstance(working_dir, str) else list(working_dir or [])
+        if inventory:
+            self.working_dirs += [d for d in read_inventory(inventory) if d not in self.working_dirs]
 
         # I not working directory provided, check if CWD has an ARK server.
-        self.working_dir = working_dir
-        if not working_dir:
+        self.working_dir = self.working_dirs[0] if self.working_dirs else None
+        if not self.working_dir:
             self.working_dir_check()
+            self.working_dirs = [self.working_dir]
+
+        # Queries are answered from the index alone and need neither SteamCMD nor a download
+        if list_mods or which_map or largest or reindex:
+            self.query_index(list_mods, which_map, largest, reindex)
+            return
+
+        # Before any thread or SteamCMD is started so they all inherit the priority
+        if nice:
+            lower_priority()
+
+        if backend:
+            try:
+                arkit.set_backend(backend)
+            except (ImportError, ValueError) as e:
+                print("[x] Decompression Backend {} Is Not Available: {}".format(backend, e))
+                sys.exit(0)
+        print("[+] Using The {} Decompression Backend".format(arkit.get_backend()))
 
         self.steamcmd = steamcmd  # Path to SteamCMD exe
 
@@ -26,25 +848,234 @@ class ArkModDownloader():
 
         self.modname = modname
         self.installed_mods = []  # List to hold installed mods
+        self.mod_title = ""  # Mod name from mod.info
         self.map_names = []  # Stores map names from mod.info
         self.meta_data = OrderedDict([])  # Stores key value from modmeta.info
-        self.temp_mod_path = os.path.join(os.path.dirname(self.steamcmd), r"steamapps\workshop\content\346110")
+        self.temp_mod_path = os.path.join(os.path.dirname(self.steamcmd), "steamapps", "workshop", "content", "346110")
         self.preserve = preserve
+        self.clean_mods = clean_mods  # Only remove the mods being installed from SteamCMD's cache
+        self.direct = direct  # Extract straight into the server's Mods folder
+        self.workers = workers  # Number of .z files extracted at the same time, caps the decompression threads
+        self.large_archive = 32 * 1024 * 1024  # .z files this big get every worker on their chunks, one at a time
+        self.throttle = arkit.Throttle(max_write * 1024 * 1024) if max_write else None  # Shared write rate limit of extraction and copies
+        self.queue_size = 2  # Mods allowed to wait between pipeline stages
+        self.download_batch_size = max(1, download_batch_size)  # Mods downloaded per SteamCMD session
+        self.state_dir = os.path.join(self.working_dir, "ArkModDownloader")  # Manifests and other state kept between runs
+        self.source_manifests = {}  # Manifest of the downloaded content, saved once the mod is installed
+        self.sessions = []  # Warm SteamCMD sessions, one per concurrent download, only used in daemon mode
+        self.runner = SteamCmdRunner(self.steamcmd, timeout, retries)
+        self.concurrency = max(1, concurrency)  # SteamCMD processes running at the same time
+        self.store_dir = store_dir or os.path.join(os.path.dirname(self.steamcmd), "ArkModStore")  # Content addressed store shared by all servers
+        self.fanout = len(self.working_dirs) > 1 or bool(store_dir)  # Install every mod into several servers from the store
+        self.mod_targets = {}  # Mod ID to the servers it is installed into, all servers if missing
+        self.chunk_cache = arkit.ChunkCache(chunk_cache, chunk_cache_size * 1024 * 1024) if chunk_cache else None  # Decompressed chunks reused across updates
+        self.jobs = OrderedDict()  # Daemon mode job queue, job ID to job
+        self.jobs_lock = threading.Condition()
+
+        for working_dir in self.working_dirs:
+            restore_swapped(os.path.join(working_dir, "ShooterGame", "Content", "Mods"))
+
+        if verify:
+            corrupt, corrupt_cache = self.verify_mods()
+            if repair and corrupt_cache:
+                # Bad archives are only in SteamCMD's cache, drop them so they are downloaded again instead of installed
+                self.invalidate_mods(corrupt_cache)
+            if repair and corrupt:
+                print("[+] Reinstalling Corrupt Mods: " + ", ".join(corrupt))
+                for modid, servers in corrupt.items():
+                    for working_dir, bad in servers.items():
+                        # Without its manifest the check stage can not skip the mod
+                        if os.path.isfile(self.manifest_path(modid, working_dir)):
+                            os.remove(self.manifest_path(modid, working_dir))
+                        # Installed files are hard links to the store, a damaged one must not be linked in again
+                        for sha1 in bad if self.fanout else []:
+                            if os.path.isfile(self.store_path(sha1)):
+                                os.remove(self.store_path(sha1))
+                    if modid not in (modids or []):
+                        # Only reinstalled where it is corrupt, not added to every server
+                        self.mod_targets[modid] = list(servers)
+                modids = list(modids or []) + [modid for modid in corrupt if modid not in (modids or [])]
+
+        if not modids and not mod_update:
+            return
+
+        try:
+            self.prep_steamcmd()
+
+            if mod_update:
+                print("[+] Mod Update Is Selected.  Updating Your Existing Mods")
+                self.update_mods()
+
+            if modids:
+                self.install_mods(modids)
+        finally:
+            self.metrics.summary()
+            self.metrics.close()
+            if self.chunk_cache:
+                cache = self.chunk_cache
+                print("[+] Chunk Cache: {} Hits, {} Reused From Installed Files, {} Misses, {:.1f} MB".format(cache.hits, cache.reused, cache.misses, cache.size / 1024 / 1024))
+
+    def install_mods(self, modids):
+        """
+        Download, extract and install a list of mods as a pipeline.
+        Each stage runs in its own thread with a bounded queue in between, so the next mod downloads while the
+        current one is being extracted and installed.
+        :return: OrderedDict of mod ID to per stage results
+        """
 
-        self.prep_steamcmd()
+        results = OrderedDict((str(mod), OrderedDict()) for mod in modids)
+        if self.clean_mods:
+            invalidate = [modid for modid in results if not self.resumable(modid)]
+            if invalidate:
+                self.invalidate_mods(invalidate)
+
+        if self.fanout:
+            self.register_servers()
+            stages = [("check", self.check_mod), ("extract", self.extract_mod), ("install", self.install_mod_fanout)]
+        elif self.direct:
+            stages = [("check", self.check_mod), ("extract", self.extract_mod_direct), ("install", self.install_mod_direct)]
+        else:
+            stages = [("check", self.check_mod), ("extract", self.extract_mod), ("install", self.install_mod)]
+
+        inboxes = [queue.Queue(maxsize=self.queue_size) for _ in stages]
+        threads = [threading.Thread(target=self.run_download_stage, args=(list(results), inboxes[0], results))]
+        for i, (name, func) in enumerate(stages):
+            outbox = inboxes[i + 1] if i + 1 < len(inboxes) else None
+            threads.append(threading.Thread(target=self.run_stage, args=(name, func, inboxes[i], outbox, results)))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        if mod_update:
-            print("[+] Mod Update Is Selected.  Updating Your Existing Mods")
-            self.update_mods()
+        if self.fanout:
+            self.prune_store()
+        self.print_install_summary(results)
+        return results
 
-        # If any issues happen in download and extract chain this returns false
-        if modids:
-            for mod in modids:
-                if self.download_mod(mod):
-                    if self.move_mod(mod):
-                        print("[+] Mod {} Installation Finished".format(str(mod)))
+    def run_download_stage(self, modids, outbox, results):
+        """
+        Worker loop for the download stage.  Mods are downloaded in batches of download_batch_size per SteamCMD
+        session and every mod that downloaded is handed to the extract stage.
+        :return:
+        """
+        try:
+            resumed = [modid for modid in modids if self.resumable(modid)]
+            if resumed:
+                print("[+] Resuming Interrupted Installs Of Mods " + ", ".join(resumed))
+                self.finish_download(resumed, {modid: True for modid in resumed}, time.time(), outbox, results)
+                modids = [modid for modid in modids if modid not in resumed]
+
+            # A journal left behind without its download belongs to a run that can not be resumed
+            for modid in modids:
+                self.clear_journal(modid)
+
+            batches = [modids[i:i + self.download_batch_size] for i in range(0, len(modids), self.download_batch_size)]
+            asyncio.run(self.download_batches(batches, outbox, results))
+        finally:
+            outbox.put(None)
+
+    async def download_batches(self, batches, outbox, results):
+        """
+        Run up to concurrency SteamCMD processes at once, handing each batch to the extract stage as soon as it is done.
+        In daemon mode each batch goes to a free warm session instead of a new process
+        :return:
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        sessions = asyncio.Queue()
+        for session in self.sessions:
+            sessions.put_nowait(session)
+
+        async def download_batch(batch):
+            async with semaphore:
+                start = time.time()
+                runner = await sessions.get() if self.sessions else self.runner
+                try:
+                    reported = await runner.download(batch)
+                    downloaded = self.check_downloads(batch, reported, start)
+                except Exception as e:
+                    print("[x] Mods {} Failed During download: {}".format(", ".join(batch), e))
+                    downloaded = {}
+                finally:
+                    if self.sessions:
+                        sessions.put_nowait(runner)
+            # The queue is bounded, wait for room without blocking the other downloads
+            await loop.run_in_executor(None, self.finish_download, batch, downloaded, start, outbox, results)
+
+        await asyncio.gather(*[download_batch(batch) for batch in batches])
+
+    def finish_download(self, batch, downloaded, start, outbox, results):
+        seconds = (time.time() - start) / len(batch)
+        for modid in batch:
+            ok = downloaded.get(modid, False)
+            results[modid]["download"] = {"ok": ok, "seconds": seconds}
+            if ok:
+                self.journal_stage(modid, "download")
+                outbox.put(modid)
+            else:
+                self.clear_journal(modid)
+                print("[x] There was a problem during the download of mod {}.  See above errors".format(modid))
+
+    def run_stage(self, name, func, inbox, outbox, results):
+        """
+        Worker loop for a single pipeline stage.  Mods that pass this stage are handed to the next one.
+        A None in the inbox marks the end of the work and is passed on.  If the loop dies the inbox is still drained
+        so the earlier stages are not left blocked on a full queue.
+        :return:
+        """
+        modid = ""
+        try:
+            while True:
+                modid = inbox.get()
+                if modid is None:
+                    return
+
+                start = time.time()
+                try:
+                    outcome = func(modid)
+                except Exception as e:
+                    print("[x] Mod {} Failed During {}: {}".format(modid, name, e))
+                    outcome = False
+                skipped = outcome is SKIPPED
+                ok = skipped or bool(outcome)
+                results[modid][name] = {"ok": ok, "seconds": time.time() - start, "skipped": skipped}
+
+                # The journal only outlives a run that was killed, failed installs start over
+                if skipped or not ok or outbox is None:
+                    self.clear_journal(modid)
+
+                if skipped:
+                    print("[+] Mod {} Is Unchanged.  Skipping Install".format(modid))
+                elif not ok:
+                    print("[x] There was a problem during the {} of mod {}.  See above errors".format(name, modid))
+                elif outbox is not None:
+                    outbox.put(modid)
                 else:
-                    print("[+] There was as problem downloading mod {}.  See above errors".format(str(mod)))
+                    print("[+] Mod {} Installation Finished".format(modid))
+        finally:
+            while modid is not None:
+                modid = inbox.get()
+            if outbox is not None:
+                outbox.put(None)
+
+    def print_install_summary(self, results):
+        print("[+] Install Summary:")
+        totals = OrderedDict()
+        skipped = 0
+        for modid, stages in results.items():
+            finished = stages.get("install", {}).get("ok", False)
+            if any(stage.get("skipped") for stage in stages.values()):
+                finished = True
+                skipped += 1
+            timings = ", ".join("{} {:.1f}s".format(name, stage["seconds"]) for name, stage in stages.items())
+            print("[{}] {} - {}".format("+" if finished else "x", modid, timings))
+            for name, stage in stages.items():
+                totals[name] = totals.get(name, 0) + stage["seconds"]
+        if totals:
+            print("[+] Stage Totals: " + ", ".join("{} {:.1f}s".format(name, seconds) for name, seconds in totals.items()))
+        if skipped:
+            print("[+] {} Unchanged Mods Skipped".format(skipped))
 
     def create_mod_name_txt(self, mod_folder, modid):
         print(os.path.join(mod_folder, self.map_names[0] + " - " + modid + ".txt"))
@@ -54,7 +1085,7 @@ class ArkModDownloader():
     def working_dir_check(self):
         print("[!] No working directory provided.  Checking Current Directory")
         print("[!] " + os.getcwd())
-        if os.path.isdir(os.path.join(os.getcwd(), "ShooterGame\Content")):
+        if os.path.isdir(os.path.join(os.getcwd(), "ShooterGame", "Content")):
             print("[+] Current Directory Has Ark Server.  Using The Current Directory")
             self.working_dir = os.getcwd()
         else:
@@ -84,9 +1115,9 @@ class ArkModDownloader():
             return True
 
         # Check working directory
-        if os.path.isfile(os.path.join(self.working_dir, "SteamCMD\steamcmd.exe")):
+        if os.path.isfile(os.path.join(self.working_dir, "SteamCMD", "steamcmd.exe")):
             print("[+] Located SteamCMD")
-            self.steamcmd = os.path.join(self.working_dir, "SteamCMD\steamcmd.exe")
+            self.steamcmd = os.path.join(self.working_dir, "SteamCMD", "steamcmd.exe")
             return True
 
         print("[+} SteamCMD Not Found In Common Locations. Attempting To Download")
@@ -113,10 +1144,11 @@ class ArkModDownloader():
             print("[x] ERROR: " + e)
             return False
 
-        self.steamcmd = os.path.join(self.working_dir, r"SteamCMD\steamcmd.exe")
+        self.steamcmd = os.path.join(self.working_dir, "SteamCMD", "steamcmd.exe")
 
         return True
 
+    @instrumented("prep_steamcmd")
     def prep_steamcmd(self):
         """
         Delete steamapp folder to prevent Steam from remembering it has downloaded this mod before
@@ -125,11 +1157,18 @@ class ArkModDownloader():
         :return:
         """
 
-        if self.preserve:
+        if self.preserve or self.clean_mods:
             return
 
         steamapps = os.path.join(os.path.dirname(self.steamcmd), "steamapps")
 
+        # Downloads of interrupted installs are set aside and put back so those installs can resume
+        resumed = [modid for modid in self.journaled_mods() if self.resumable(modid)]
+        holding = os.path.join(os.path.dirname(self.steamcmd), "ArkModResume")
+        for modid in resumed:
+            os.makedirs(holding, exist_ok=True)
+            os.replace(os.path.join(self.temp_mod_path, modid), os.path.join(holding, modid))
+
         if os.path.isdir(steamapps):
             print("[+] Removing Steamapps Folder")
             try:
@@ -143,88 +1182,863 @@ class ArkModDownloader():
                 print("[x] Failed To Remove Steamapps Folder. This is normally okay.")
                 print("[x] If this is a TCAdmin Server and using the TCAdmin SteamCMD it may prevent mod from downloading")
 
+        for modid in resumed:
+            os.makedirs(self.temp_mod_path, exist_ok=True)
+            os.replace(os.path.join(holding, modid), os.path.join(self.temp_mod_path, modid))
+        if os.path.isdir(holding):
+            os.rmdir(holding)
+
+    def invalidate_mods(self, modids):
+        """
+        Targeted alternative to prep_steamcmd.  Only the given mods are removed from SteamCMD's cache, their content
+        and download folders plus their entries in appworkshop_346110.acf, leaving every other cached item intact.
+        :return:
+        """
+        workshop = os.path.join(os.path.dirname(self.steamcmd), "steamapps", "workshop")
+        print("[+] Removing Mods From SteamCMD Cache: " + ", ".join(modids))
+
+        try:
+            for modid in modids:
+                for folder in ("content", "downloads"):
+                    path = os.path.join(workshop, folder, "346110", modid)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+
+            acf = os.path.join(workshop, "appworkshop_346110.acf")
+            if not os.path.isfile(acf):
+                return
+
+            with open(acf, encoding="utf-8") as f:
+                manifest = parse_vdf(f.read())
+
+            for app in manifest.values():
+                for section in ("WorkshopItemsInstalled", "WorkshopItemDetails"):
+                    items = app.get(section)
+                    if isinstance(items, dict):
+                        for modid in modids:
+                            items.pop(modid, None)
+
+            with open(acf, "w", encoding="utf-8") as f:
+                f.write(dump_vdf(manifest) + "\n")
+        except OSError as e:
+            print("[x] Failed To Remove Mods From SteamCMD Cache: {}".format(e))
+            print("[x] If this is a TCAdmin Server and using the TCAdmin SteamCMD it may prevent mod from downloading")
+
+    def serve(self, host="127.0.0.1", port=8765):
+        """
+        Daemon mode.  Keep the resolved configuration and a warm SteamCMD session per concurrent download around and
+        take install and update jobs over a local HTTP API, see JobRequestHandler.
+        Jobs are worked off in rounds.  Every job queued when a round starts is included and each mod ID is only
+        downloaded and installed once per round, no matter how many jobs asked for it.
+        Since the SteamCMD session stays open, SteamCMD's cache is cleaned per mod rather than by deleting steamapps.
+        :return:
+        """
+        if not self.preserve:
+            self.clean_mods = True
+        self.sessions = [SteamCmdSession(self.steamcmd, self.runner.item_timeout, self.runner.retries, self.runner.backoff)
+                         for _ in range(self.concurrency)]
+
+        server = http.server.ThreadingHTTPServer((host, port), JobRequestHandler)
+        server.downloader = self
+        threading.Thread(target=self.run_jobs, daemon=True).start()
+
+        print("[+] Listening For Jobs On http://{}:{}/jobs".format(host, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("[+] Shutting Down")
+        finally:
+            server.server_close()
+            for session in self.sessions:
+                session.close()
+            self.metrics.close()
+
+    def find_servers(self, working_dirs):
+        """
+        Match working directories given to a job against the servers the daemon was started with
+        :return: List of the matching entries of working_dirs, None for a directory that is not one of them
+        """
+        known = {os.path.abspath(working_dir): working_dir for working_dir in self.working_dirs}
+        return [known.get(os.path.abspath(working_dir)) for working_dir in working_dirs]
+
+    def submit_job(self, modids, update=False, working_dirs=None):
+        with self.jobs_lock:
+            job = OrderedDict([("id", str(len(self.jobs) + 1)), ("modids", modids), ("update", update),
+                               ("workingdirs", list(working_dirs or self.working_dirs)), ("status", "queued"),
+                               ("submitted", time.time()), ("started", None), ("finished", None), ("results", {})])
+            self.jobs[job["id"]] = job
+            self.jobs_lock.notify()
+            return job
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.jobs_lock:
+            return list(self.jobs.values())
+
+    def run_jobs(self):
+        """
+        Daemon mode worker loop.  Takes every queued job and runs them together, see run_round
+        :return:
+        """
+        while True:
+            with self.jobs_lock:
+                while not any(job["status"] == "queued" for job in self.jobs.values()):
+                    self.jobs_lock.wait()
+                batch = [job for job in self.jobs.values() if job["status"] == "queued"]
+                for job in batch:
+                    job["status"] = "running"
+                    job["started"] = time.time()
+            self.run_round(batch)
+
+    def run_round(self, batch):
+        """
+        Install the union of the mods of several jobs, each mod once and into every server a job asked for it on,
+        then hand the per mod results back to each job.  Update jobs add the mods installed on each of their servers
+        :return:
+        """
+        targets = OrderedDict()
+        for job in batch:
+            requested = list(job["modids"])
+            for working_dir in job["workingdirs"]:
+                modids = list(requested)
+                if job["update"]:
+                    modids += list_mod_dirs(os.path.join(working_dir, "ShooterGame", "Content", "Mods"))
+                for modid in modids:
+                    if working_dir not in targets.setdefault(modid, []):
+                        targets[modid].append(working_dir)
+                job["modids"] = list(OrderedDict.fromkeys(job["modids"] + modids))
+
+        self.mod_targets = targets
+        modids = list(targets)
+        print("[+] Running {} Jobs For Mods: {}".format(len(batch), ", ".join(modids)))
+        try:
+            results = self.install_mods(modids) if modids else {}
+        except Exception as e:
+            print("[x] Jobs Failed: {}".format(e))
+            results = {}
+        finally:
+            self.mod_targets = {}
+
+        self.metrics.close()
+        # The daemon runs for weeks, only the series written so far are kept between rounds
+        self.metrics.reset()
+        with self.jobs_lock:
+            for job in batch:
+                job["results"] = OrderedDict((modid, results.get(modid, {})) for modid in job["modids"])
+                ok = all(any(stage.get("skipped") for stage in stages.values()) or stages.get("install", {}).get("ok") for stages in job["results"].values())
+                job["status"] = "done" if ok else "failed"
+                job["finished"] = time.time()
+
     def update_mods(self):
-        self.build_list_of_mods()
+        if self.fanout:
+            # Each mod is only updated on the servers that already have it
+            for working_dir in self.working_dirs:
+                for modid in self.build_list_of_mods(working_dir):
+                    targets = self.mod_targets.setdefault(modid, [])
+                    if working_dir not in targets:
+                        targets.append(working_dir)
+            self.installed_mods = list(self.mod_targets)
+        else:
+            self.build_list_of_mods()
+
         if self.installed_mods:
-            for mod in self.installed_mods:
-                print("[+] Updating Mod " + mod)
-                if not self.download_mod(mod):
-                    print("[x] Error Updating Mod " + mod)
+            print("[+] Updating Mods: " + ", ".join(self.installed_mods))
+            self.install_mods(self.installed_mods)
         else:
             print("[+] No Installed Mods Found.  Skipping Update")
 
-    def build_list_of_mods(self):
+    def build_list_of_mods(self, working_dir=None):
         """
         Build a list of all installed mods by grabbing all directory names from the mod folder
-        :return:
+        :return: List of mod IDs
         """
-        if not os.path.isdir(os.path.join(self.working_dir, "ShooterGame\Content\Mods")):
-            return
-        for curdir, dirs, files in os.walk(os.path.join(self.working_dir, "ShooterGame\Content\Mods")):
-            for d in dirs:
-                self.installed_mods.append(d)
-            break
+        self.installed_mods = list_mod_dirs(os.path.join(working_dir or self.working_dir, "ShooterGame", "Content", "Mods"))
+        return self.installed_mods
 
     def download_mod(self, modid):
         """
         Launch SteamCMD to download ModID
-        :return:
+        :return: Bool
         """
-        print("[+] Starting Download of Mod " + str(modid))
-        args = []
-        args.append(self.steamcmd)
-        args.append("+login anonymous")
-        args.append("+workshop_download_item")
-        args.append("346110")
-        args.append(modid)
-        args.append("+quit")
-        subprocess.call(args, shell=True)
+        return self.download_mods([str(modid)])[str(modid)]
 
-        return True if self.extract_mod(modid) else False
+    def download_mods(self, modids):
+        """
+        Download several mods in a single SteamCMD session.
+        All items go to one SteamCMD process so it only starts, checks for updates and logs in once.  In daemon mode
+        they are sent to a SteamCMD session that is kept running instead.
+        :return: OrderedDict of mod ID to Bool
+        """
+        print("[+] Starting Download of Mods " + ", ".join(modids))
 
+        start = time.time()
+        reported = asyncio.run((self.sessions[0] if self.sessions else self.runner).download(modids))
 
+        return self.check_downloads(modids, reported, start)
+
+    def check_downloads(self, modids, reported, start):
+        """
+        An item counts as downloaded if SteamCMD reported it downloaded and its content directory exists.
+        The directory alone is not enough, it may be left over from an earlier download.
+        Every mod is recorded as its own download phase, the time since start split evenly between them like
+        finish_download does.
+        :return: OrderedDict of mod ID to Bool
+        """
+        seconds = (time.time() - start) / len(modids) if modids else 0
+        downloaded = OrderedDict()
+        for modid in modids:
+            downloaded[modid] = False
+            with self.metrics.measure(modid, "download", start, seconds) as event:
+                if not reported.get(modid):
+                    print("[x] SteamCMD Reported Mod {} Failed".format(modid))
+                    event["outcome"] = "failed"
+                    continue
+                if not os.path.isdir(os.path.join(self.temp_mod_path, modid, "WindowsNoEditor")):
+                    print("[x] SteamCMD Did Not Download Mod " + modid)
+                    event["outcome"] = "failed"
+                    continue
+                downloaded[modid] = True
+                for curdir, subdirs, files in os.walk(os.path.join(self.temp_mod_path, modid)):
+                    self.metrics.count(bytes_written=sum(os.path.getsize(os.path.join(curdir, file)) for file in files), files=len(files))
+
+        return downloaded
+
+    @instrumented("extract")
     def extract_mod(self, modid):
         """
         Extract the .z files using the arkit lib.
-        If any file fails to download this whole script will abort
-        :return: None
+        If any file fails to extract the install of this mod is aborted
+        :return: Bool
         """
 
+        journal = self.load_journal(modid) or {}
+        if "extract" in journal.get("stages", {}):
+            print("[+] .z Files Already Extracted")
+            return True
+
         print("[+] Extracting .z Files.")
 
-        try:
-            for curdir, subdirs, files in os.walk(os.path.join(self.temp_mod_path, modid, "WindowsNoEditor")):
-                for file in files:
-                    name, ext = os.path.splitext(file)
-                    if ext == ".z":
-                        src = os.path.join(curdir, file)
-                        dst = os.path.join(curdir, name)
-                        uncompressed = os.path.join(curdir, file + ".uncompressed_size")
-                        arkit.unpack(src, dst)
-                        #print("[+] Extracted " + file)
-                        os.remove(src)
-                        if os.path.isfile(uncompressed):
-                            os.remove(uncompressed)
-
-        except (arkit.UnpackException, arkit.SignatureUnpackException, arkit.CorruptUnpackException) as e:
+        source_dir = os.path.join(self.temp_mod_path, modid, "WindowsNoEditor")
+        installed_dir = os.path.join(self.working_dir, "ShooterGame", "Content", "Mods", modid)
+
+        jobs = []
+        for curdir, subdirs, files in os.walk(source_dir):
+            for file in files:
+                name, ext = os.path.splitext(file)
+                if ext == ".z":
+                    # The installed copy of the file lets the chunk cache skip its unchanged chunks
+                    previous = os.path.join(installed_dir, os.path.relpath(os.path.join(curdir, name), source_dir))
+                    jobs.append((os.path.join(curdir, file), os.path.join(curdir, name), previous))
+
+        # Files unpacked before an interruption have lost their .z, they have to still be complete
+        for rel, size in journal.get("unpacked", {}).items():
+            path = os.path.join(source_dir, *rel.split("/"))
+            if not os.path.isfile(path + ".z") and (not os.path.isfile(path) or os.path.getsize(path) != size):
+                print("[x] Extracted File {} Is Incomplete And Its .z File Is Gone, The Mod Will Be Downloaded Again".format(rel))
+                return False
+
+        jobs, done = self.resume_unpacks(journal, jobs, source_dir)
+        for src, dst, previous in done:
+            self.remove_archive(src)
+
+        def unpacked(result):
+            if result.error:
+                return
+            #print("[+] Extracted " + result.src)
+            self.metrics.count(bytes_read=os.path.getsize(result.src), bytes_written=os.path.getsize(result.dst), files=1)
+            self.journal_unpack(modid, journal, source_dir, result)
+            self.remove_archive(result.src)
+
+        results = self.unpack_jobs(jobs, unpacked)
+
+        failed = [result for result in results if result.error]
+        if failed:
+            for result in failed:
+                print("[x] Failed To Unpack {}: {}".format(result.src, result.error))
             print("[x] Unpacking .z files failed, aborting mod install")
             return False
 
-        if self.create_mod_file(modid):
-            if self.move_mod(modid):
-                return True
+        self.journal_stage(modid, "extract")
+        return True
+
+    def unpack_jobs(self, jobs, callback):
+        """
+        Unpack the .z files of a mod within the workers budget.  Large archives, such as the maps of map mods, come
+        first, one at a time with every worker decompressing their chunks.  The rest are unpacked side by side with
+        one worker each
+        :return: List of arkit.UnpackResult
+        """
+        large, small = [], []
+        for job in jobs:
+            (large if self.workers > 1 and os.path.getsize(job[0]) >= self.large_archive else small).append(job)
+
+        results = []
+        if large:
+            results = arkit.unpack_many(large, workers=1, chunk_workers=self.workers, cache=self.chunk_cache,
+                                        throttle=self.throttle, callback=callback)
+            if any(result.error for result in results):
+                return results
+        return results + arkit.unpack_many(small, workers=self.workers, cache=self.chunk_cache, throttle=self.throttle, callback=callback)
+
+    @staticmethod
+    def remove_archive(src):
+        os.remove(src)
+        uncompressed = src + ".uncompressed_size"
+        if os.path.isfile(uncompressed):
+            os.remove(uncompressed)
+
+    def journal_path(self, modid):
+        return os.path.join(self.state_dir, "journal", modid + ".json")
+
+    def unpack_log_path(self, modid):
+        return os.path.join(self.state_dir, "journal", modid + ".unpacked")
+
+    def load_journal(self, modid):
+        """
+        Load the journal of an install that has not finished, it records the finished stages and unpacked files.
+        Files unpacked since the journal was last saved are folded in from its unpack log
+        :return: Dict or None
+        """
+        try:
+            with open(self.journal_path(modid)) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            with open(self.unpack_log_path(modid)) as f:
+                for line in f:
+                    try:
+                        rel, size = json.loads(line)
+                    except (ValueError, TypeError):
+                        continue  # The last line may have been cut short by a kill
+                    journal.setdefault("unpacked", {})[rel] = size
+        except OSError:
+            pass
+        return journal
+
+    def save_journal(self, modid, journal):
+        path = self.journal_path(modid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so a kill never leaves a partial journal
+        with open(path + ".tmp", "w") as f:
+            json.dump(journal, f)
+        os.replace(path + ".tmp", path)
+        # The journal now holds everything the unpack log recorded
+        if os.path.isfile(self.unpack_log_path(modid)):
+            os.remove(self.unpack_log_path(modid))
+
+    def journal_stage(self, modid, stage, **values):
+        """
+        Record a finished stage of an install, along with any values to keep for a resumed run
+        :return: Dict
+        """
+        journal = self.load_journal(modid) or {"stages": {}, "unpacked": {}}
+        journal["stages"][stage] = time.time()
+        journal.update(values)
+        self.save_journal(modid, journal)
+        return journal
+
+    def journal_unpack(self, modid, journal, output_root, result):
+        """
+        Record an unpacked file with its size from the archive header, before its .z file is removed.
+        Mods can have thousands of .z files, so each one appends a line to the unpack log instead of rewriting the
+        whole journal
+        :return:
+        """
+        rel = os.path.relpath(result.dst, output_root).replace(os.sep, "/")
+        journal.setdefault("unpacked", {})[rel] = result.info.size_unpacked
+        if not os.path.isfile(self.journal_path(modid)):
+            journal.setdefault("stages", {})
+            self.save_journal(modid, journal)
+            return
+        with open(self.unpack_log_path(modid), "a") as f:
+            f.write(json.dumps([rel, result.info.size_unpacked]) + "\n")
+
+    def clear_journal(self, modid):
+        for path in (self.journal_path(modid), self.unpack_log_path(modid)):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def journaled_mods(self):
+        try:
+            return [os.path.splitext(file)[0] for file in os.listdir(os.path.join(self.state_dir, "journal")) if file.endswith(".json")]
+        except OSError:
+            return []
+
+    def resumable(self, modid):
+        """
+        An interrupted install resumes without downloading again if its download had finished and is still there
+        :return: Bool
+        """
+        journal = self.load_journal(modid)
+        return bool(journal and "download" in journal["stages"] and os.path.isdir(os.path.join(self.temp_mod_path, modid, "WindowsNoEditor")))
+
+    @staticmethod
+    def resume_unpacks(journal, jobs, output_root):
+        """
+        Split unpack jobs into the ones still to do and the ones the journal records, whose output has the size
+        recorded from the archive header
+        :return: Tuple of (pending, done) jobs
+        """
+        unpacked = journal.get("unpacked", {})
+        pending, done = [], []
+        for job in jobs:
+            rel = os.path.relpath(job[1], output_root).replace(os.sep, "/")
+            if rel in unpacked and os.path.isfile(job[1]) and os.path.getsize(job[1]) == unpacked[rel]:
+                done.append(job)
             else:
+                pending.append(job)
+        if unpacked:
+            print("[+] Resuming, {} .z Files Were Already Extracted".format(len(unpacked)))
+        return pending, done
+
+    def install_mod(self, modid):
+        """
+        Write the .mod file and move the extracted mod into the ARK server.  Steps the journal records as done are
+        skipped when an interrupted install resumes
+        :return: Bool
+        """
+        stages = (self.load_journal(modid) or {}).get("stages", {})
+        output_dir = os.path.join(self.working_dir, "ShooterGame", "Content", "Mods", modid)
+
+        if "mod_file" in stages and os.path.isfile(os.path.join(self.temp_mod_path, modid, "WindowsNoEditor", ".mod")):
+            # Still needed for the name file and the index
+            if not self.parse_base_info(modid) or not self.parse_meta_data(modid):
+                return False
+        else:
+            if not self.create_mod_file(modid):
+                return False
+            self.journal_stage(modid, "mod_file")
+
+        if "moved" not in stages or not os.path.isdir(output_dir):
+            if not self.move_mod(modid):
                 return False
+            self.journal_stage(modid, "moved")
+
+        self.save_manifest(modid)
+        self.source_manifests.pop(modid, None)
+        self.index_mod(modid)
+        return True
+
+    @instrumented("move_mod")
+    def install_mod_fanout(self, modid):
+        """
+        Multi server alternative to install_mod.
+        The extracted mod is added once to the content addressed store, then every target server gets its own
+        staging folder of hard links (or reflinks, or copies) to the stored files which is swapped into place.
+        :return: Bool
+        """
+        if "stored" in (self.load_journal(modid) or {}).get("stages", {}):
+            # The .mod file is linked to the store by now and must not be rewritten
+            if not self.parse_base_info(modid) or not self.parse_meta_data(modid):
+                return False
+        elif not self.create_mod_file(modid):
+            return False
+
+        stored = self.store_mod(modid)
+
+        for working_dir in self.mod_targets.get(modid, self.working_dirs):
+            ark_mod_folder = os.path.join(working_dir, "ShooterGame", "Content", "Mods")
+            output_dir = os.path.join(ark_mod_folder, modid)
+            staging_dir = staging_path(output_dir)
+            if os.path.isdir(staging_dir):
+                shutil.rmtree(staging_dir)
+
+            print("[+] Linking Mod Files To: " + output_dir)
+            installed = {}
+            for rel, sha1 in stored.items():
+                dst = os.path.join(staging_dir, *rel.split("/"))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                link_or_copy(self.store_path(sha1), dst, self.throttle)
+                stat = os.stat(dst)
+                installed[rel] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": sha1}
+            swap_into_place(staging_dir, output_dir)
+
+            if self.modname:
+                print("Creating Mod Name File")
+                self.create_mod_name_txt(ark_mod_folder, modid)
+
+            self.save_manifest(modid, working_dir, installed)
+            self.index_mod(modid, working_dir, installed)
+
+        # Extracted files must not stay linked to the store, a later extraction would write through them
+        shutil.rmtree(os.path.join(self.temp_mod_path, modid, "WindowsNoEditor"))
+        self.source_manifests.pop(modid, None)
+        return True
+
+    def index_path(self, working_dir=None):
+        return os.path.join(working_dir or self.working_dir, "ArkModDownloader", "index.sqlite")
+
+    def mod_index(self, working_dir=None):
+        return ModIndex(self.index_path(working_dir))
+
+    def index_mod(self, modid, working_dir=None, installed=None):
+        """
+        Record a freshly installed mod in the server's index, using the details parsed for its .mod file.
+        A server without an index yet is indexed in full, so the mods installed before it are not missing
+        :return:
+        """
+        if not os.path.isfile(self.index_path(working_dir)):
+            print("[+] Indexing Installed Mods")
+            self.reindex_mods(working_dir or self.working_dir)
+            return
+
+        if installed is None:
+            installed = scan_sizes(os.path.join(working_dir or self.working_dir, "ShooterGame", "Content", "Mods", modid))
+        size = sum(entry["size"] for entry in installed.values())
+        self.mod_index(working_dir).update(modid, self.mod_title, self.map_names, self.meta_data, size, len(installed))
+
+    def reindex_mods(self, working_dir):
+        """
+        Rebuild the index of a server from the mod.info and modmeta.info files of its installed mods.
+        The details parsed for the mod being installed, if any, are left as they were
+        :return: ModIndex
+        """
+        parsed = self.mod_title, self.map_names, self.meta_data
+        index = self.mod_index(working_dir)
+        index.delete()
+        mods_folder = os.path.join(working_dir, "ShooterGame", "Content", "Mods")
+        try:
+            for modid in list_mod_dirs(mods_folder):
+                mod_dir = os.path.join(mods_folder, modid)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if not self.parse_base_info(modid, mod_dir) or not self.parse_meta_data(modid, mod_dir):
+                        print("[x] Skipping Mod {}, mod.info Or modmeta.info Is Missing".format(modid), file=sys.stderr)
+                        continue
+                installed = scan_sizes(mod_dir)
+                index.update(modid, self.mod_title, self.map_names, self.meta_data, sum(entry["size"] for entry in installed.values()),
+                             len(installed), os.path.getmtime(mod_dir))
+        finally:
+            self.mod_title, self.map_names, self.meta_data = parsed
+        return index
+
+    def query_index(self, list_mods=False, which_map=None, largest=None, reindex=False):
+        """
+        Print the mods of every server from its index.  The index is built from the Mods folder when it does not
+        exist yet or a reindex is requested
+        :return:
+        """
+        for working_dir in self.working_dirs:
+            if len(self.working_dirs) > 1:
+                print("[+] " + working_dir)
+
+            if reindex or not os.path.isfile(self.index_path(working_dir)):
+                print("[+] Indexing Installed Mods")
+                index = self.reindex_mods(working_dir)
+            else:
+                index = self.mod_index(working_dir)
+
+            if which_map:
+                print("[+] Mods Providing Map " + which_map)
+                rows = index.which_map(which_map)
+            elif largest:
+                print("[+] Largest {} Mods".format(largest))
+                rows = index.largest(largest)
+            elif list_mods:
+                rows = index.mods()
+            else:
+                rows = []
+
+            for row in rows:
+                print("    {:<12} {:<40} {:>10.1f} MB  {}  {}".format(row["modid"], row["name"][:40], row["size"] / 1024 / 1024,
+                                                                time.strftime("%Y-%m-%d %H:%M", time.localtime(row["installed"])),
+                                                                ", ".join(row["maps"])))
+            if list_mods or which_map or largest:
+                print("[+] {} Mods".format(len(rows)))
+
+    def store_path(self, sha1):
+        return os.path.join(self.store_dir, "objects", sha1[:2], sha1)
+
+    def store_mod(self, modid):
+        """
+        Move the extracted files of a mod into the content addressed store, files the store already has are dropped.
+        Files are hard linked (or copied) into the store and the result is journaled, so an interrupted install
+        resumes with the complete list.  install_mod_fanout removes the extracted files once every server has them
+        :return: Dict of relative path to SHA1
+        """
+        journal = self.load_journal(modid) or {}
+        if "stored" in journal.get("stages", {}):
+            return journal["stored"]
+
+        source_dir = os.path.join(self.temp_mod_path, modid, "WindowsNoEditor")
+        stored = {}
+        for curdir, subdirs, files in os.walk(source_dir):
+            for file in files:
+                path = os.path.join(curdir, file)
+                sha1 = hash_file(path)
+                stored[os.path.relpath(path, source_dir).replace(os.sep, "/")] = sha1
+                obj = self.store_path(sha1)
+                if not os.path.isfile(obj):
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    try:
+                        os.link(path, obj)
+                    except OSError:
+                        copy_file(path, obj + ".tmp", self.throttle)
+                        os.replace(obj + ".tmp", obj)
+        self.journal_stage(modid, "stored", stored=stored)
+        return stored
+
+    def store_servers(self):
+        """
+        Servers that have had mods installed from the store, by this run or any other
+        :return: List of working directories
+        """
+        try:
+            with open(os.path.join(self.store_dir, "servers.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
 
+    def register_servers(self):
+        """
+        Add the servers of this run to store_servers, so other runs sharing the store keep their files when pruning
+        :return:
+        """
+        path = os.path.join(self.store_dir, "servers.json")
+        servers = self.store_servers()
+        added = [os.path.abspath(working_dir) for working_dir in self.working_dirs if os.path.abspath(working_dir) not in servers]
+        if added:
+            os.makedirs(self.store_dir, exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(servers + added, f, indent=1)
+            os.replace(path + ".tmp", path)
+
+    def prune_store(self, grace=3600):
+        """
+        Remove the stored files no server refers to any more.
+        A file is kept while a manifest or an unfinished install journal of any server in store_servers lists it.
+        Files added to the store within the last grace seconds are kept too, they may belong to an install still
+        running elsewhere.  Servers keep their own links or copies, so pruning only loses the sharing of a file.
+        :return:
+        """
+        referenced = set()
+        for working_dir in self.store_servers():
+            for folder, key in (("manifests", "installed"), ("journal", "stored")):
+                folder = os.path.join(working_dir, "ArkModDownloader", folder)
+                if not os.path.isdir(folder):
+                    continue
+                for name in os.listdir(folder):
+                    if not name.endswith(".json"):
+                        continue
+                    try:
+                        with open(os.path.join(folder, name)) as f:
+                            entries = json.load(f).get(key) or {}
+                    except (OSError, ValueError) as e:
+                        print("[!] Not Pruning The Store, {} Is Unreadable: {}".format(os.path.join(folder, name), e))
+                        return
+                    for entry in entries.values():
+                        referenced.add(entry.get("sha1") if isinstance(entry, dict) else entry)
+
+        removed = 0
+        freed = 0
+        now = time.time()
+        objects = os.path.join(self.store_dir, "objects")
+        for curdir, subdirs, files in os.walk(objects):
+            for file in files:
+                path = os.path.join(curdir, file)
+                try:
+                    stat = os.stat(path)
+                    if file in referenced or now - stat.st_ctime < grace:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed += 1
+                freed += stat.st_size
+            if curdir != objects and not os.listdir(curdir):
+                try:
+                    os.rmdir(curdir)
+                except OSError:
+                    pass
+
+        if removed:
+            print("[+] Pruned {} Unused Files ({:.1f} MB) From The Store".format(removed, freed / 1048576))
+
+    def manifest_path(self, modid, working_dir=None):
+        return os.path.join(working_dir or self.working_dir, "ArkModDownloader", "manifests", modid + ".json")
+
+    def load_manifest(self, modid, working_dir=None):
+        """
+        Load the manifest saved the last time this mod was installed
+        :return: Dict or None
+        """
+        try:
+            with open(self.manifest_path(modid, working_dir)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_manifest(self, modid, working_dir=None, installed=None):
+        """
+        Record the downloaded content, the generated .mod file and the installed files of an installed mod.
+        The installed files are scanned unless they are passed in, files unchanged since the previous manifest
+        keep its hashes.
+        :return:
+        """
+        source = self.source_manifests.get(modid)
+        if source is None:
+            return
+
+        output_dir = os.path.join(working_dir or self.working_dir, "ShooterGame", "Content", "Mods", modid)
+        if installed is None:
+            installed = scan_tree(output_dir, (self.load_manifest(modid, working_dir) or {}).get("installed"))
+        manifest = {"source": source, "mod_file": hash_file(os.path.join(output_dir, ".mod")), "installed": installed}
 
+        path = self.manifest_path(modid, working_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    def build_source_manifest(self, modid, previous=None):
+        """
+        Size, mtime and SHA1 of every file SteamCMD downloaded for a mod, see scan_tree
+        :return: Dict of relative path to file details
+        """
+        return scan_tree(os.path.join(self.temp_mod_path, modid, "WindowsNoEditor"), previous)
+
+    def verify_mods(self):
+        """
+        Check every installed mod on every server against the file digests in its manifest, and every .z archive
+        still waiting in SteamCMD's download folder with arkit.verify, without writing anything.
+        The checks run across a pool of workers.  Hashes, and archives found intact, are cached by path, size and
+        mtime in each server's verify_cache.json so files that have not changed since the last verify are not read
+        again.
+        :return: OrderedDict of installed mod IDs with corrupt files to an OrderedDict of the servers they are corrupt
+                 on to the expected SHA1s of the bad files, list of mod IDs with corrupt archives in SteamCMD's cache
+        """
+        print("[+] Verifying Installed Mods")
+
+        caches, new_caches = {}, {}
+        for working_dir in self.working_dirs:
+            try:
+                with open(self.verify_cache_path(working_dir)) as f:
+                    caches[working_dir] = json.load(f)
+            except (OSError, ValueError):
+                caches[working_dir] = {}
+            new_caches[working_dir] = {}
+
+        def check_file(path, expected, cache, new_cache):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return "Missing"
+            if stat.st_size != expected["size"]:
+                return "Size Mismatch"
+            key = "{}|{}|{}".format(path, stat.st_size, stat.st_mtime_ns)
+            sha1 = cache.get(key) or hash_file(path)
+            new_cache[key] = sha1
+            return None if sha1 == expected["sha1"] else "Hash Mismatch"
+
+        def check_archive(path, cache, new_cache):
+            try:
+                stat = os.stat(path)
+                key = "{}|{}|{}".format(path, stat.st_size, stat.st_mtime_ns)
+                if not cache.get(key):
+                    arkit.verify(path)
+            except (arkit.UnpackException, OSError, zlib.error) as e:
+                return str(e)
+            new_cache[key] = True
+            return None
+
+        corrupt = OrderedDict()  # Mod ID to server to the expected SHA1s of bad files
+        corrupt_cache = OrderedDict()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for working_dir in self.working_dirs:
+                ark_mod_folder = os.path.join(working_dir, "ShooterGame", "Content", "Mods")
+                for modid in self.build_list_of_mods(working_dir):
+                    installed = (self.load_manifest(modid, working_dir) or {}).get("installed")
+                    if installed is None:
+                        print("[!] No Manifest For Mod {} In {}.  Cannot Verify It".format(modid, working_dir))
+                        continue
+                    for rel, expected in installed.items():
+                        path = os.path.join(ark_mod_folder, modid, *rel.split("/"))
+                        future = executor.submit(check_file, path, expected, caches[working_dir], new_caches[working_dir])
+                        futures[future] = (path, corrupt.setdefault(modid, OrderedDict()).setdefault(working_dir, []), expected["sha1"])
+
+            # SteamCMD's cache is shared by all servers, its archives are cached with the first one
+            if os.path.isdir(self.temp_mod_path):
+                for modid in os.listdir(self.temp_mod_path):
+                    for curdir, subdirs, files in os.walk(os.path.join(self.temp_mod_path, modid)):
+                        for file in files:
+                            if file.endswith(".z"):
+                                path = os.path.join(curdir, file)
+                                future = executor.submit(check_archive, path, caches[self.working_dir], new_caches[self.working_dir])
+                                futures[future] = (path, corrupt_cache.setdefault(modid, []), path)
+
+            for future in concurrent.futures.as_completed(futures):
+                error = future.result()
+                if error:
+                    path, found, bad = futures[future]
+                    print("[x] {}: {}".format(path, error))
+                    found.append(bad)
+
+        for working_dir, new_cache in new_caches.items():
+            os.makedirs(os.path.dirname(self.verify_cache_path(working_dir)), exist_ok=True)
+            with open(self.verify_cache_path(working_dir), "w") as f:
+                json.dump(new_cache, f)
+
+        corrupt_servers = OrderedDict()
+        for modid, servers in corrupt.items():
+            for working_dir, bad in servers.items():
+                if bad:
+                    print("[x] Mod {} Is Corrupt In {}, {} Bad Files".format(modid, working_dir, len(bad)))
+                    corrupt_servers.setdefault(modid, OrderedDict())[working_dir] = bad
+        corrupt_cache = [modid for modid, paths in corrupt_cache.items() if paths]
+        for modid in corrupt_cache:
+            print("[x] Cached Download Of Mod {} Is Corrupt".format(modid))
+        print("[+] Verified {} Files.  {} Corrupt Mods And {} Corrupt Cached Downloads Found".format(len(futures), len(corrupt_servers),
+                                                                                                      len(corrupt_cache)))
+        return corrupt_servers, corrupt_cache
+
+    def verify_cache_path(self, working_dir=None):
+        return os.path.join(working_dir or self.working_dir, "ArkModDownloader", "verify_cache.json")
+
+    def check_mod(self, modid):
+        """
+        Compare the downloaded content against the manifest from the last install.
+        If nothing changed and the installed .mod file is intact there is nothing to extract or install.
+        :return: True to continue with the install, SKIPPED if the mod is unchanged
+        """
+        # A resumed install was already checked, its content may be partly extracted by now
+        journal = self.load_journal(modid)
+        if journal and "source" in journal:
+            self.source_manifests[modid] = journal["source"]
+            return True
+
+        working_dirs = self.mod_targets.get(modid, self.working_dirs) if self.fanout else [self.working_dir]
+        manifests = [self.load_manifest(modid, working_dir) or {} for working_dir in working_dirs]
+        source = self.build_source_manifest(modid, manifests[0].get("source"))
+        self.source_manifests[modid] = source
+
+        def digests(entries):
+            return {rel: (entry["size"], entry["sha1"]) for rel, entry in entries.items()}
+
+        # Every server the mod goes to has to be up to date
+        for working_dir, manifest in zip(working_dirs, manifests):
+            mod_file = os.path.join(working_dir, "ShooterGame", "Content", "Mods", modid, ".mod")
+            if (not manifest or digests(source) != digests(manifest["source"]) or
+                    not os.path.isfile(mod_file) or hash_file(mod_file) != manifest.get("mod_file")):
+                self.journal_stage(modid, "check", source=source)
+                return True
+
+        self.source_manifests.pop(modid, None)
+        return SKIPPED
+
+
+    @instrumented("move_mod")
     def move_mod(self, modid):
         """
         Move mod from SteamCMD download location to the ARK server.
-        It will delete an existing mod with the same ID
+        An existing mod with the same ID is synced in place, only changed files are copied and stale files removed
         :return:
         """
 
-        ark_mod_folder = os.path.join(self.working_dir, "ShooterGame\Content\Mods")
+        ark_mod_folder = os.path.join(self.working_dir, "ShooterGame", "Content", "Mods")
         output_dir = os.path.join(ark_mod_folder, str(modid))
         source_dir = os.path.join(self.temp_mod_path, modid, "WindowsNoEditor")
 
@@ -233,29 +2047,128 @@ class ArkModDownloader():
             print("[+] Creating Directory: " + ark_mod_folder)
             os.mkdir(ark_mod_folder)
 
-        if os.path.isdir(output_dir):
-            shutil.rmtree(output_dir)
-
         print("[+] Moving Mod Files To: " + output_dir)
-        shutil.copytree(source_dir, output_dir)
+        installed = (self.load_manifest(modid) or {}).get("installed")
+        copied, unchanged, deleted, copied_bytes = sync_tree(source_dir, output_dir, self.throttle, installed)
+        print("[+] Copied {} Files, {} Unchanged, {} Removed".format(copied, unchanged, deleted))
+        self.metrics.count(bytes_read=copied_bytes, bytes_written=copied_bytes, files=copied)
+
+        if self.modname:
+            print("Creating Mod Name File")
+            self.create_mod_name_txt(ark_mod_folder, modid)
+
+        return True
+
+    @instrumented("extract")
+    def extract_mod_direct(self, modid):
+        """
+        Single pass alternative to extract_mod and move_mod.
+        The .z files are decompressed straight into a staging folder inside the server's Mods folder and every
+        other file is reflinked (or copied) there, so each file is only written once.  The downloaded mod is
+        left untouched.
+        :return: Bool
+        """
+        ark_mod_folder = os.path.join(self.working_dir, "ShooterGame", "Content", "Mods")
+        source_dir = os.path.join(self.temp_mod_path, modid, "WindowsNoEditor")
+        staging_dir = staging_path(os.path.join(ark_mod_folder, modid))
+
+        journal = self.load_journal(modid) or {}
+        if "extract" in journal.get("stages", {}) and (os.path.isdir(staging_dir) or "moved" in journal["stages"]):
+            print("[+] .z Files Already Extracted")
+            return True
+
+        # A staging folder is only kept when the journal says what in it is complete
+        if os.path.isdir(staging_dir) and not journal.get("unpacked"):
+            shutil.rmtree(staging_dir)
+
+        print("[+] Extracting .z Files To: " + staging_dir)
+
+        jobs = []
+        for curdir, subdirs, files in os.walk(source_dir):
+            output_dir = os.path.join(staging_dir, os.path.relpath(curdir, source_dir))
+            os.makedirs(output_dir, exist_ok=True)
+            for file in files:
+                name, ext = os.path.splitext(file)
+                if ext == ".z":
+                    previous = os.path.join(ark_mod_folder, modid, os.path.relpath(curdir, source_dir), name)
+                    jobs.append((os.path.join(curdir, file), os.path.join(output_dir, name), previous))
+                elif not file.endswith(".z.uncompressed_size"):
+                    dst = os.path.join(output_dir, file)
+                    if os.path.isfile(dst):
+                        os.remove(dst)
+                    # Never a hard link, a later download or an in place update would write through it into the server
+                    try:
+                        reflink(os.path.join(curdir, file), dst)
+                    except OSError:
+                        copy_file(os.path.join(curdir, file), dst, self.throttle)
+
+        jobs, done = self.resume_unpacks(journal, jobs, staging_dir)
+
+        def unpacked(result):
+            if not result.error:
+                self.metrics.count(bytes_read=os.path.getsize(result.src), bytes_written=os.path.getsize(result.dst), files=1)
+                self.journal_unpack(modid, journal, staging_dir, result)
+
+        results = self.unpack_jobs(jobs, unpacked)
+
+        failed = [result for result in results if result.error]
+        if failed:
+            for result in failed:
+                print("[x] Failed To Unpack {}: {}".format(result.src, result.error))
+            print("[x] Unpacking .z files failed, aborting mod install")
+            shutil.rmtree(staging_dir)
+            return False
+
+        self.journal_stage(modid, "extract")
+        return True
+
+    @instrumented("move_mod")
+    def install_mod_direct(self, modid):
+        """
+        Write the .mod file into the staging folder built by extract_mod_direct and swap it in with a rename
+        :return: Bool
+        """
+        ark_mod_folder = os.path.join(self.working_dir, "ShooterGame", "Content", "Mods")
+        output_dir = os.path.join(ark_mod_folder, modid)
+        staging_dir = staging_path(output_dir)
+
+        if "moved" in (self.load_journal(modid) or {}).get("stages", {}) and os.path.isdir(output_dir):
+            # Swapped in before an interruption, still needed for the name file and the index
+            if not self.parse_base_info(modid) or not self.parse_meta_data(modid):
+                return False
+        else:
+            if not self.create_mod_file(modid, staging_dir):
+                shutil.rmtree(staging_dir)
+                return False
+
+            print("[+] Moving Mod Files To: " + output_dir)
+            swap_into_place(staging_dir, output_dir)
+            self.journal_stage(modid, "moved")
 
         if self.modname:
             print("Creating Mod Name File")
             self.create_mod_name_txt(ark_mod_folder, modid)
 
+        self.save_manifest(modid)
+        self.source_manifests.pop(modid, None)
+        self.index_mod(modid)
         return True
 
-    def create_mod_file(self, modid):
+    @instrumented("create_mod_file")
+    def create_mod_file(self, modid, output_dir=None):
         """
         Create the .mod file.
         This code is an adaptation of the code from Ark Server Launcher.  All credit goes to Face Wound on Steam
+        The file is written to the downloaded mod unless output_dir is given.
         :return:
         """
         if not self.parse_base_info(modid) or not self.parse_meta_data(modid):
             return False
 
+        output_dir = output_dir or os.path.join(self.temp_mod_path, modid, "WindowsNoEditor")
+
         print("[+] Writing .mod File")
-        with open(os.path.join(self.temp_mod_path, modid, r"WindowsNoEditor\.mod"), "w+b") as f:
+        with open(os.path.join(output_dir, ".mod"), "w+b") as f:
 
             modid = int(modid)
             f.write(struct.pack('ixxxx', modid))  # Needs 4 pad bits
@@ -288,6 +2201,7 @@ class ArkModDownloader():
                 self.write_ue4_string(k, f)
                 self.write_ue4_string(v, f)
 
+        self.metrics.count(bytes_written=os.path.getsize(os.path.join(output_dir, ".mod")), files=1)
         return True
 
     def read_ue4_string(self, file):
@@ -309,7 +2223,7 @@ class ArkModDownloader():
         file.write(barray)
         file.write(struct.pack('p', b'0'))
 
-    def parse_meta_data(self, modid):
+    def parse_meta_data(self, modid, mod_dir=None):
         """
         Parse the modmeta.info files and extract the key value pairs need to for the .mod file.
         How To Parse modmeta.info:
@@ -319,13 +2233,15 @@ class ArkModDownloader():
             4. Read next 4 bytes to tell how many bytes to read ahead to get value
             5. Read ahead by the number of bytes retrieved from step 4
             6. Start at step 2 again
-        :return: Dict
+        The pairs replace the meta data of the previous mod.  mod_dir defaults to the downloaded mod
+        :return: Bool
         """
 
         print("[+] Collecting Mod Meta Data From modmeta.info")
         print("[+] Located The Following Meta Data:")
 
-        mod_meta = os.path.join(self.temp_mod_path, modid, r"WindowsNoEditor\modmeta.info")
+        self.meta_data = OrderedDict([])
+        mod_meta = os.path.join(mod_dir or os.path.join(self.temp_mod_path, modid, "WindowsNoEditor"), "modmeta.info")
         if not os.path.isfile(mod_meta):
             print("[x] Failed To Locate modmeta.info. Cannot continue without it.  Aborting")
             return False
@@ -367,18 +2283,25 @@ class ArkModDownloader():
         return True
 
 
-    def parse_base_info(self, modid):
+    def parse_base_info(self, modid, mod_dir=None):
+        """
+        Read the mod name and map names from mod.info, replacing those of the previous mod.
+        mod_dir defaults to the downloaded mod
+        :return: Bool
+        """
 
         print("[+] Collecting Mod Details From mod.info")
 
-        mod_info = os.path.join(self.temp_mod_path, modid, r"WindowsNoEditor\mod.info")
+        self.mod_title = ""
+        self.map_names = []
+        mod_info = os.path.join(mod_dir or os.path.join(self.temp_mod_path, modid, "WindowsNoEditor"), "mod.info")
 
         if not os.path.isfile(mod_info):
             print("[x] Failed to locate mod.info. Cannot Continue.  Aborting")
             return False
 
         with open(mod_info, "rb") as f:
-            self.read_ue4_string(f)
+            self.mod_title = self.read_ue4_string(f)
             map_count = struct.unpack('i', f.read(4))[0]
 
             for i in range(map_count):
@@ -392,26 +2315,76 @@ class ArkModDownloader():
 
 def main():
     parser = argparse.ArgumentParser(description="A utility to download ARK Mods via SteamCMD")
-    parser.add_argument("--workingdir", default=None, dest="workingdir", help="Game server home directory.  Current Directory is used if this is not provided")
+    parser.add_argument("--workingdir", nargs="+", default=None, dest="workingdir", help="Game server home directory.  Current Directory is used if this is not provided.  Several servers can be given")
+    parser.add_argument("--inventory", default=None, dest="inventory", help="File listing game server home directories, one per line")
+    parser.add_argument("--store", default=None, dest="store_dir", help="Content store shared by all servers.  Defaults to ArkModStore next to SteamCMD")
     parser.add_argument("--modids", nargs="+", default=None, dest="modids", help="ID of Mod To Download")
     parser.add_argument("--steamcmd", default=None, dest="steamcmd", help="Path to SteamCMD")
     parser.add_argument("--update", default=None, action="store_true", dest="mod_update", help="Update Existing Mods.  ")
     parser.add_argument("--preserve", default=None, action="store_true", dest="preserve", help="Don't Delete StreamCMD Content Between Runs")
+    parser.add_argument("--cleanmods", default=None, action="store_true", dest="clean_mods", help="Only Remove The Requested Mods From SteamCMD's Cache Instead Of All Of Steamapps")
+    parser.add_argument("--direct", default=None, action="store_true", dest="direct", help="Extract .z Files Straight Into The Server's Mods Folder")
+    parser.add_argument("--verify", default=None, action="store_true", dest="verify", help="Verify Installed Mods And Pending .z Files Against Their Manifests")
+    parser.add_argument("--repair", default=None, action="store_true", dest="repair", help="Reinstall Mods That --verify Finds Corrupt")
+    parser.add_argument("--metrics-jsonl", default=None, dest="metrics_jsonl", help="Append Per Mod, Per Phase Metrics To This JSON Lines File")
+    parser.add_argument("--metrics-prom", default=None, dest="metrics_prom", help="Write Per Mod, Per Phase Metrics To This Prometheus Textfile Collector File")
+    parser.add_argument("--daemon", default=None, action="store_true", dest="daemon", help="Keep Running And Accept Install/Update Jobs Over A Local HTTP API")
+    parser.add_argument("--port", default=8765, type=int, dest="port", help="Port For The --daemon API, Only Listens On localhost")
     parser.add_argument("--namefile", default=None, action="store_true", dest="modname", help="Create a .name File With Mods Text Name")
+    parser.add_argument("--workers", default=4, type=int, dest="workers", help="Number of .z Files To Extract At The Same Time")
+    parser.add_argument("--chunkcache", default=None, dest="chunk_cache", help="Cache Decompressed .z Chunks In This Directory So Updates Only Decompress Changed Chunks")
+    parser.add_argument("--chunkcachesize", default=2048, type=int, dest="chunk_cache_size", help="Size Limit Of The --chunkcache In MB")
+    parser.add_argument("--list", default=None, action="store_true", dest="list_mods", help="List Installed Mods From The Index")
+    parser.add_argument("--which-map", default=None, dest="which_map", help="List Installed Mods Providing This Map")
+    parser.add_argument("--largest", default=None, type=int, dest="largest", help="List This Many Of The Largest Installed Mods")
+    parser.add_argument("--reindex", default=None, action="store_true", dest="reindex", help="Rebuild The Index Of Installed Mods From The Mods Folder")
+    parser.add_argument("--concurrency", default=1, type=int, dest="concurrency", help="Number of SteamCMD Processes To Run At The Same Time")
+    parser.add_argument("--timeout", default=1800, type=int, dest="timeout", help="Seconds A Single Mod May Take To Download Before SteamCMD Is Killed")
+    parser.add_argument("--retries", default=3, type=int, dest="retries", help="Number of Times A Failed Download Is Retried")
+    parser.add_argument("--maxwrite", default=None, type=float, dest="max_write", help="Limit Extraction And Copies To This Many MB/s Written")
+    parser.add_argument("--nice", default=None, action="store_true", dest="nice", help="Run At Low CPU And I/O Priority")
+    parser.add_argument("--backend", default=None, choices=["isal", "zlib-ng", "zlib"], dest="backend", help="Decompression Backend.  Defaults To ARKIT_BACKEND Or The Fastest One Installed")
+    parser.add_argument("--batchsize", default=1, type=int, dest="batch_size", help="Number of Mods To Download In One SteamCMD Session")
 
     args = parser.parse_args()
 
-    if not args.modids and not args.mod_update:
+    query = args.list_mods or args.which_map or args.largest or args.reindex
+    if not args.modids and not args.mod_update and not args.verify and not args.daemon and not query:
         print("[x] No Mod ID Provided and Update Not Selected.  Aborting")
         print("[?] Please provide a Mod ID to download or use --update to update your existing mods")
         sys.exit(0)
 
-    ArkModDownloader(args.steamcmd,
-                     args.modids,
-                     args.workingdir,
-                     args.mod_update,
-                     args.modname,
-                     args.preserve)
+    downloader = ArkModDownloader(args.steamcmd,
+                                  args.modids,
+                                  args.workingdir,
+                                  args.mod_update,
+                                  args.modname,
+                                  args.preserve,
+                                  args.workers,
+                                  args.batch_size,
+                                  args.clean_mods,
+                                  args.direct,
+                                  args.verify,
+                                  args.repair,
+                                  args.metrics_jsonl,
+                                  args.metrics_prom,
+                                  args.inventory,
+                                  args.store_dir,
+                                  args.chunk_cache,
+                                  args.chunk_cache_size,
+                                  args.list_mods,
+                                  args.which_map,
+                                  args.largest,
+                                  args.reindex,
+                                  args.concurrency,
+                                  args.timeout,
+                                  args.retries,
+                                  args.max_write,
+                                  args.nice,
+                                  args.backend)
+
+    if args.daemon:
+        downloader.serve(port=args.port)
 
 
 
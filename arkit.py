@@ -11,7 +11,18 @@ Notice:
 '''
 
 
+import array
+import collections
+import concurrent.futures
+import hashlib
+import importlib
+import itertools
+import json
+import mmap
+import os
 import struct
+import threading
+import time
 import zlib
 import sys
 import logging
@@ -37,7 +48,519 @@ class SignatureUnpackException(UnpackException):
 class CorruptUnpackException(UnpackException):
     pass
 
-def unpack(src, dst):
+UnpackResult = collections.namedtuple('UnpackResult', ['src', 'dst', 'error', 'info'], defaults=(None,))
+
+class ArchiveInfo(object):
+    '''
+    Header and compression index of a *.z archive, see read_info.
+
+    Attributes:
+        chunk_size = Unpacked/uncompressed size of a full chunk
+        size_packed = Packed/compressed full size
+        size_unpacked = Unpacked/uncompressed full size
+        data_offset = Offset of the first compressed chunk, right after the index
+        index = Compact array of (compressed, uncompressed) sizes, flattened as [compressed, uncompressed, compressed, ...]
+    '''
+
+    def __init__(self, chunk_size, size_packed, size_unpacked, index):
+        self.chunk_size = chunk_size
+        self.size_packed = size_packed
+        self.size_unpacked = size_unpacked
+        self.index = index
+        self.data_offset = _HEADER.size + index.itemsize * len(index)
+
+    def __len__(self):
+        return len(self.index) // 2
+
+    def __repr__(self):
+        return "ArchiveInfo(chunk_size={}, size_packed={}, size_unpacked={}, chunks={})".format(self.chunk_size, self.size_packed, self.size_unpacked, len(self))
+
+    @property
+    def chunk_table(self):
+        '''
+        List of (offset, compressed, uncompressed) for every chunk in the archive.
+        '''
+        table = []
+        offset = self.data_offset
+        for i in range(0, len(self.index), 2):
+            compressed, uncompressed = self.index[i], self.index[i + 1]
+            table.append((offset, compressed, uncompressed))
+            offset += compressed
+        return table
+
+class ChunkCache(object):
+    '''
+    On-disk cache of decompressed chunks keyed by the SHA1 of the compressed chunk, see unpack.
+
+    Updated workshop archives mostly repeat the compressed chunks of the previous version, so those chunks can be taken
+    from this cache or from the previous output file instead of being inflated again. The layout (chunk keys in order) of
+    every file written by unpack is kept as well, identified by the size and modification time of the file, which makes
+    the unchanged ranges of an earlier output reusable in place. The layout holds the digest of every decompressed
+    chunk and a range is only reused when it still matches.
+
+    Accepts one argument:
+        path = Cache Directory
+
+    Optional arguments:
+        max_bytes = Size limit of the cache, least recently used entries are evicted once it is exceeded.
+
+    Attributes:
+        hits = Chunks read from the cache
+        misses = Chunks looked up but not in the cache
+        reused = Chunks copied from the previous output file
+        evictions = Entries removed to stay under max_bytes
+    '''
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.reused = self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+        #Rebuild the LRU order from the modification times, hits touch the file
+        found = []
+        for curdir, subdirs, files in os.walk(path):
+            for file in files:
+                full = os.path.join(curdir, file)
+                if file.endswith('.tmp'):
+                    os.remove(full)
+                    continue
+                stat = os.stat(full)
+                found.append((stat.st_mtime, os.path.relpath(full, path), stat.st_size))
+        for mtime, name, size in sorted(found):
+            self._entries[name] = size
+            self._size += size
+
+    def __repr__(self):
+        return "ChunkCache(path={!r}, size={}, hits={}, misses={}, reused={}, evictions={})".format(self.path, self._size, self.hits, self.misses, self.reused, self.evictions)
+
+    @property
+    def size(self):
+        return self._size
+
+    def _read(self, name):
+        full = os.path.join(self.path, name)
+        try:
+            with open(full, 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._size -= self._entries.pop(name, 0)
+            return None
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        try:
+            os.utime(full)
+        except OSError:
+            pass
+        return data
+
+    def _write(self, name, data, throttle=None):
+        full = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = "{}.{}.tmp".format(full, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, full)
+        if throttle:
+            throttle.consume(len(data))
+
+        evicted = []
+        with self._lock:
+            self._size += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                oldest, size = self._entries.popitem(last=False)
+                self._size -= size
+                self.evictions += 1
+                evicted.append(oldest)
+        for oldest in evicted:
+            try:
+                os.remove(os.path.join(self.path, oldest))
+            except OSError:
+                pass
+
+    def get(self, key):
+        '''
+        Decompressed chunk for the key, or None.
+        '''
+        data = self._read(os.path.join('chunks', key[:2], key))
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data, throttle=None):
+        if len(data) <= self.max_bytes:
+            self._write(os.path.join('chunks', key[:2], key), data, throttle)
+
+    def _layout_name(self, stat):
+        return os.path.join('layouts', "{}-{}".format(stat.st_size, stat.st_mtime_ns))
+
+    def layout(self, path):
+        '''
+        (chunk_size, keys, digests) of a file written by unpack, or None if the file is missing, unknown or modified since.
+        Layouts are found by size and modification time, which different files can share, so every range reused from
+        the file has to be checked against its digest.
+        '''
+        try:
+            raw = self._read(self._layout_name(os.stat(path)))
+        except OSError:
+            return None
+        if raw is None:
+            return None
+        layout = json.loads(raw.decode('utf-8'))
+        if len(layout.get('digests', ())) != len(layout['keys']):
+            return None
+        return layout['chunk_size'], layout['keys'], layout['digests']
+
+    def record_layout(self, path, chunk_size, keys, digests, throttle=None):
+        layout = {'chunk_size': chunk_size, 'keys': keys, 'digests': digests}
+        self._write(self._layout_name(os.stat(path)), json.dumps(layout).encode('utf-8'), throttle)
+
+class Throttle(object):
+    '''
+    Token bucket limiting the rate at which bytes are written, shared by every thread writing through it.
+
+    Accepts one argument:
+        rate = Bytes per second
+
+    Optional arguments:
+        burst = Bytes that may be written at once before the limit kicks in, defaults to one second worth.
+
+    Writers call consume after each write and sleep for as long as the bucket is in debt, so the combined rate of
+    all writers stays at rate.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Throttle(rate={}, burst={})".format(self.rate, self.burst)
+
+    def consume(self, size):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate) - size
+            self._last = now
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class _CachedChunks(object):
+    '''
+    Chunk lookups of a single unpack: the previous output file first, then the ChunkCache.
+    The key of every chunk looked up and the digest of every chunk written are kept in order to record the layout
+    of the new output.
+    '''
+
+    def __init__(self, cache, previous):
+        self.cache = cache
+        self.keys = []
+        self.digests = []
+        self.offsets = {}
+        self.previous = None
+
+        layout = cache.layout(previous) if previous else None
+        if layout:
+            chunk_size, keys, digests = layout
+            self.offsets = {key: (n * chunk_size, digest) for n, (key, digest) in enumerate(zip(keys, digests))}
+            self.previous = open(previous, 'rb')
+
+    def lookup(self, chunk, uncompressed):
+        '''
+        Returns (key, data), data is None if the chunk has to be decompressed.
+        '''
+        key = hashlib.sha1(chunk).hexdigest()
+        self.keys.append(key)
+
+        if key in self.offsets:
+            offset, digest = self.offsets[key]
+            self.previous.seek(offset)
+            data = self.previous.read(uncompressed)
+            if len(data) == uncompressed and hashlib.sha1(data).hexdigest() == digest:
+                with self.cache._lock:
+                    self.cache.reused += 1
+                return key, data
+        return key, self.cache.get(key)
+
+    def written(self, data):
+        self.digests.append(hashlib.sha1(data).hexdigest())
+
+    def close(self):
+        if self.previous:
+            self.previous.close()
+
+#Decompression backends, fastest first. All of them inflate the same zlib streams.
+_BACKEND_MODULES = collections.OrderedDict([
+    ('isal', 'isal.isal_zlib'),
+    ('zlib-ng', 'zlib_ng.zlib_ng'),
+    ('zlib', 'zlib'),
+])
+_backends = {}
+_backend = None
+
+def _load_backend(name):
+    if name not in _BACKEND_MODULES:
+        raise ValueError("Unknown backend {}, choose from {}.".format(name, ", ".join(_BACKEND_MODULES)))
+    if name not in _backends:
+        _backends[name] = importlib.import_module(_BACKEND_MODULES[name])
+    return _backends[name]
+
+def available_backends():
+    '''
+    Names of the decompression backends that can be imported, fastest first. zlib is always available.
+    '''
+    names = []
+    for name in _BACKEND_MODULES:
+        try:
+            _load_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def get_backend():
+    return _backend
+
+def set_backend(name=None):
+    '''
+    Selects the decompression backend used by unpack and verify.
+
+    Optional arguments:
+        name = 'isal', 'zlib-ng' or 'zlib'. Defaults to the ARKIT_BACKEND environment variable, or when that is not set
+               the fastest backend installed. Raises ValueError for an unknown backend and ImportError when it is not installed.
+
+    Returns the name of the selected backend.
+    '''
+    global _backend
+    name = name or os.environ.get('ARKIT_BACKEND') or available_backends()[0]
+    _load_backend(name)
+    _backend = name
+    logging.info("Using the {} decompression backend.".format(name))
+    return name
+
+def _inflate(chunk, backend=None):
+    '''
+    Decompresses one chunk with the given backend, errors of every backend are raised as CorruptUnpackException.
+    Module level and selected by name so it can be sent to a process pool.
+    '''
+    module = _load_backend(backend or _backend)
+    try:
+        return module.decompress(chunk)
+    except module.error as e:
+        msg = "Chunk failed to decompress: {}".format(e)
+        logging.critical(msg)
+        raise CorruptUnpackException(msg)
+
+def benchmark_backends(src, rounds=3):
+    '''
+    Measures the throughput of every available backend inflating the chunks of an archive, without writing anything.
+
+    Accepts one argument:
+        src = Source File/Archive, the chunks are read into memory first so only decompression is timed.
+
+    Optional arguments:
+        rounds = Passes over the archive per backend, the fastest one counts.
+
+    Returns an OrderedDict of backend name to MB/s of uncompressed output.
+    '''
+    info = read_info(src)
+    with open(src, 'rb') as f:
+        data = f.read()
+    chunks = [data[offset:offset + compressed] for offset, compressed, uncompressed in info.chunk_table]
+
+    results = collections.OrderedDict()
+    for name in available_backends():
+        best = None
+        for i in range(max(1, rounds)):
+            start = time.perf_counter()
+            for chunk in chunks:
+                _inflate(chunk, name)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        results[name] = info.size_unpacked / best / 1024 / 1024 if best else float('inf')
+    return results
+
+_HEADER = struct.Struct('qqqq')
+
+def _parse_archive(buf):
+    '''
+    Reads and verifies the archive header, then decodes the whole compression index with one bulk read into an array.
+
+    Accepts any buffer (bytes or a memory mapped file) starting at the beginning of the archive. Returns an ArchiveInfo.
+    '''
+    if len(buf) < _HEADER.size:
+        msg = "Archive is only {} bytes, too small to hold the {} byte header.".format(len(buf), _HEADER.size)
+        logging.critical(msg)
+        raise CorruptUnpackException(msg)
+
+    sigver, size_unpacked_chunk, size_packed, size_unpacked = _HEADER.unpack_from(buf, 0)
+
+    #Verify the integrity of the Archive Header
+    if sigver != 2653586369:
+        msg = "The signature and format version is incorrect. Signature was {} should be 2653586369.".format(sigver)
+        logging.critical(msg)
+        raise SignatureUnpackException(msg)
+
+    if size_unpacked_chunk <= 0 or size_packed < 0 or size_unpacked < 0:
+        msg = "Archive header sizes are invalid. Unpacked Chunk: {} Full Packed: {} Full Unpacked: {}".format(size_unpacked_chunk, size_packed, size_unpacked)
+        logging.critical(msg)
+        raise CorruptUnpackException(msg)
+
+    logging.info("Archive is valid.")
+    logging.debug("Archive header size information. Unpacked Chunk: {} Full Packed: {} Full Unpacked: {}".format(size_unpacked_chunk, size_packed, size_unpacked))
+
+    #Obtain the Archive Compression Index, a valid archive has exactly this many chunks
+    chunks = -(-size_unpacked // size_unpacked_chunk)
+    end = _HEADER.size + chunks * 16
+    if len(buf) < end:
+        msg = "Archive is truncated. The compression index needs {} bytes but the archive is only {} bytes.".format(end, len(buf))
+        logging.critical(msg)
+        raise CorruptUnpackException(msg)
+
+    index = array.array('q')
+    index.frombytes(buf[_HEADER.size:end])
+
+    #The index ends as soon as the chunk sizes add up to the full unpacked size
+    size_indexed = 0
+    for i, size_indexed in enumerate(itertools.accumulate(index[1::2])):
+        if size_indexed >= size_unpacked:
+            del index[(i + 1) * 2:]
+            break
+
+    if size_unpacked != size_indexed:
+        msg = "Header-Index mismatch. Header indicates it should only have {} bytes when uncompressed but the index indicates {} bytes.".format(size_unpacked, size_indexed)
+        logging.critical(msg)
+        raise CorruptUnpackException(msg)
+
+    return ArchiveInfo(size_unpacked_chunk, size_packed, size_unpacked, index)
+
+def read_info(src):
+    '''
+    Reads the header and compression index of a *.z archive without decompressing it.
+
+    Accepts one argument:
+        src = Source File/Archive
+
+    Returns an ArchiveInfo, raises the same exceptions as unpack for an invalid header or index.
+    '''
+    with open(src, 'rb') as f:
+        header = f.read(_HEADER.size)
+        if len(header) == _HEADER.size:
+            sigver, size_unpacked_chunk, size_packed, size_unpacked = _HEADER.unpack(header)
+            if size_unpacked_chunk > 0 and size_unpacked > 0:
+                header += f.read(-(-size_unpacked // size_unpacked_chunk) * 16)
+        return _parse_archive(header)
+
+def _verify_chunk(size, uncompressed, size_unpacked_chunk, read_data, total_chunks):
+    '''
+    Verifies a single decompressed chunk against the archive index and header.
+    '''
+    #Verify the size of the data is consistent with the archives index
+    if size != uncompressed:
+        msg = "Uncompressed chunk size is not the same as in the index: was {} but should be {}.".format(size, uncompressed)
+        logging.critical(msg)
+        raise CorruptUnpackException(msg)
+
+    #Verify there is only one partial chunk
+    if size != size_unpacked_chunk and read_data != total_chunks:
+        msg = "Index contains more than one partial chunk: was {} when the full chunk size is {}, chunk {}/{}".format(size, size_unpacked_chunk, read_data, total_chunks)
+        logging.critical(msg)
+        raise CorruptUnpackException(msg)
+
+def _unpack_serial(view, out, info, cached=None, throttle=None, backend=None):
+    '''
+    Decompresses the chunks of an archive one at a time, straight from zero-copy slices of the mapped file.
+    '''
+    read_data = 0
+    for offset, compressed, uncompressed in info.chunk_table:
+        with view[offset:offset + compressed] as chunk:
+            key, uncompressed_data = cached.lookup(chunk, uncompressed) if cached else (None, None)
+            if uncompressed_data is None:
+                uncompressed_data = _inflate(chunk, backend)
+                if cached:
+                    cached.cache.put(key, uncompressed_data, throttle)
+        read_data += 1
+        _verify_chunk(len(uncompressed_data), uncompressed, info.chunk_size, read_data, len(info))
+        out.write(uncompressed_data)
+        if cached:
+            cached.written(uncompressed_data)
+        if throttle:
+            throttle.consume(len(uncompressed_data))
+
+def _unpack_parallel(view, out, info, workers, processes, cached=None, throttle=None, backend=None):
+    '''
+    Decompresses the chunks of an archive across a pool of workers.
+
+    Every backend releases the GIL while inflating so a thread pool scales on its own and is handed zero-copy slices of the mapped file;
+    a process pool can be requested instead, in which case each chunk is copied to send it to the worker.
+    At most workers * 2 chunks are in flight, and results are consumed in index order so every chunk lands at its own offset in the output.
+    Chunks found by the cache lookups are queued as finished futures.
+    '''
+    pool = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    window = workers * 2
+    with pool(max_workers=workers) as executor:
+        pending = collections.deque()
+        chunks = iter(info.chunk_table)
+        read_data = 0
+        try:
+            while True:
+                while len(pending) < window:
+                    entry = next(chunks, None)
+                    if entry is None:
+                        break
+                    offset, compressed, uncompressed = entry
+                    chunk = view[offset:offset + compressed]
+                    key, uncompressed_data = cached.lookup(chunk, uncompressed) if cached else (None, None)
+                    if uncompressed_data is not None:
+                        chunk.release()
+                        chunk = None
+                        future = concurrent.futures.Future()
+                        future.set_result(uncompressed_data)
+                    else:
+                        if processes:
+                            with chunk:
+                                chunk = chunk.tobytes()
+                        future = executor.submit(_inflate, chunk, backend)
+                    pending.append((future, chunk, uncompressed, key))
+                    del chunk, uncompressed_data
+                if not pending:
+                    break
+                future, chunk, uncompressed, key = pending.popleft()
+                try:
+                    uncompressed_data = future.result()
+                finally:
+                    if isinstance(chunk, memoryview):
+                        chunk.release()
+                if cached and chunk is not None:
+                    cached.cache.put(key, uncompressed_data, throttle)
+                read_data += 1
+                _verify_chunk(len(uncompressed_data), uncompressed, info.chunk_size, read_data, len(info))
+                out.write(uncompressed_data)
+                if cached:
+                    cached.written(uncompressed_data)
+                if throttle:
+                    throttle.consume(len(uncompressed_data))
+        finally:
+            #Every slice has to be released before the mapping can be closed
+            for future, chunk, uncompressed, key in pending:
+                future.cancel()
+            concurrent.futures.wait([future for future, chunk, uncompressed, key in pending])
+            for future, chunk, uncompressed, key in pending:
+                if isinstance(chunk, memoryview):
+                    chunk.release()
+
+def unpack(src, dst, workers=1, processes=False, cache=None, previous=None, throttle=None, backend=None):
     '''
     Unpacks ARK's Steam Workshop *.z archives.
 
@@ -45,12 +568,22 @@ def unpack(src, dst):
         src = Source File/Archive
         dst = Destination File
 
+    Optional arguments:
+        workers = Number of workers used to decompress chunks in parallel, the default of 1 decompresses serially.
+        processes = Use a process pool instead of a thread pool for the parallel workers.
+        cache = ChunkCache, chunks it already holds are not decompressed again and new chunks are added to it.
+        previous = Earlier output of the same asset, for example the installed file of the previous version of a mod.
+                   Its unchanged chunks are copied from it when the cache knows its layout. Defaults to dst, in which case
+                   the new output is written next to it and renamed over it once complete.
+        throttle = Throttle limiting the write rate, each chunk is written through it.
+        backend = Decompression backend for this archive, defaults to the one selected with set_backend.
+
     Error Handling:
         Currently logs errors via logging with an archive integrity as well as raising a custom exception. Also logs some debug and info messages.
-        All file system errors are handled by python core.
+        All file system errors are handled by python core. A partially written destination file is removed if the archive turns out to be corrupt.
 
     Process:
-        1. Open the source file.
+        1. Memory map the source file.
         2. Read header information from archive:
             - 00 (8 bytes) signature (6 bytes) and format ver (2 bytes)
             - 08 (8 byes) unpacked/uncompressed chunk size
@@ -59,78 +592,195 @@ def unpack(src, dst):
             - 20 (8 bytes) first chunk packed/compressed size
             - 26 (8 bytes) first chunk unpacked/uncompressed size
             - 20 and 26 repeat until the total of all the unpacked/uncompressed chunk sizes matches the unpacked/uncompressed full size.
-        2. Read all the archive data and verify integrity (there should only be one partial chunk, and each chunk should match the archives header).
-        3. Write the file.
+           The whole index is decoded in one bulk read, see read_info.
+        3. Stream the archive data one chunk at a time, verifying the integrity of each chunk (there should only be one partial chunk, and each chunk should match the archives header)
+           and writing it straight to the destination. Peak memory use is about one chunk rather than the whole file.
+           When workers is greater than 1 the chunks are decompressed in parallel and written in the same order, so the output is byte-identical to the serial path.
+           With a cache each compressed chunk is hashed first and looked up in the previous output, then in the cache, before it is decompressed.
 
     Development Note:
         - Not thoroughly tested for errors. There may be instances where this method may fail either to extract a valid archive or detect a corrupt archive.
         - Prevent overwriting files unless requested to do so.
-        - Create a batch method.
+        - Use unpack_many to unpack a batch of archives.
+
+    Returns the ArchiveInfo of the archive.
     '''
 
     with open(src, 'rb') as f:
-        sigver = struct.unpack('q', f.read(8))[0]
-        unpacked_chunk = f.read(8)
-        packed = f.read(8)
-        unpacked = f.read(8)
-        size_unpacked_chunk = struct.unpack('q', unpacked_chunk)[0]
-        size_packed = struct.unpack('q', packed)[0]
-        size_unpacked = struct.unpack('q', unpacked)[0]
-
-        #Verify the integrity of the Archive Header
-        if sigver == 2653586369:
-            if isinstance(size_unpacked_chunk, int) and isinstance(size_packed , int) and isinstance(size_unpacked , int):
-                logging.info("Archive is valid.")
-                logging.debug("Archive header size information. Unpacked Chunk: {}({}) Full Packed: {}({}) Full Unpacked: {}({})".format(size_unpacked_chunk, unpacked_chunk, size_packed, packed, size_unpacked, unpacked))
-
-                #Obtain the Archive Compression Index
-                compression_index = []
-                size_indexed = 0
-                while size_indexed < size_unpacked:
-                    raw_compressed = f.read(8)
-                    raw_uncompressed = f.read(8)
-                    compressed = struct.unpack('q', raw_compressed)[0]
-                    uncompressed = struct.unpack('q', raw_uncompressed)[0]
-                    compression_index.append((compressed, uncompressed))
-                    size_indexed += uncompressed
-                    logging.debug("{}: {}/{} ({}/{}) - {} - {}".format(len(compression_index), size_indexed, size_unpacked, compressed, uncompressed, raw_compressed, raw_uncompressed))
-
-                if size_unpacked != size_indexed:
-                    msg = "Header-Index mismatch. Header indicates it should only have {} bytes when uncompressed but the index indicates {} bytes.".format(size_unpacked, size_indexed)
-                    logging.critical(msg)
-                    raise CorruptUnpackException(msg)
-
-                #Read the actual archive data
-                data = b''
-                read_data = 0
-                for compressed, uncompressed in compression_index:
-                    compressed_data = f.read(compressed)
-                    uncompressed_data = zlib.decompress(compressed_data)
-
-                    #Verify the size of the data is consistent with the archives index
-                    if len(uncompressed_data) == uncompressed:
-                        data += uncompressed_data
-                        read_data += 1
-
-                        #Verify there is only one partial chunk
-                        if len(uncompressed_data) != size_unpacked_chunk and read_data != len(compression_index):
-                            msg = "Index contains more than one partial chunk: was {} when the full chunk size is {}, chunk {}/{}".format(len(uncompressed_data), size_unpacked_chunk, read_data, len(compression_index))
-                            logging.critical(msg)
-                            raise CorruptUnpackException(msg)
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            _parse_archive(f.read())
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            info = _parse_archive(view)
+
+            cached = None
+            output = dst
+            if cache is not None:
+                previous = previous or dst
+                cached = _CachedChunks(cache, previous)
+                if cached.previous and os.path.abspath(previous) == os.path.abspath(dst):
+                    output = dst + '.part'
+
+            try:
+                with open(output, 'wb') as out:
+                    if workers > 1:
+                        _unpack_parallel(view, out, info, workers, processes, cached, throttle, backend or _backend)
                     else:
-                        msg = "Uncompressed chunk size is not the same as in the index: was {} but should be {}.".format(len(uncompressed_data), uncompressed)
-                        logging.critical(msg)
-                        raise CorruptUnpackException(msg)
-            else:
-                msg = "Data types in the headers should be int's. Size Types: unpacked_chunk({}), packed({}), unpacked({})".format(sigver, type(size_unpacked_chunk), type(size_packed), type(size_unpacked))
+                        _unpack_serial(view, out, info, cached, throttle, backend)
+            except Exception:
+                if os.path.isfile(output):
+                    os.remove(output)
+                raise
+            finally:
+                if cached:
+                    cached.close()
+
+            if output != dst:
+                os.replace(output, dst)
+            if cached:
+                cache.record_layout(dst, info.chunk_size, cached.keys, cached.digests, throttle)
+
+    logging.info("Archive has been extracted.")
+    return info
+
+def pack(src, dst, chunk_size=131072, level=zlib.Z_DEFAULT_COMPRESSION, workers=4, sidecar=False):
+    '''
+    Packs a file into ARK's Steam Workshop *.z archive format, the reverse of unpack.
+
+    Accepts two arguments:
+        src = Source File
+        dst = Destination File/Archive
+
+    Optional arguments:
+        chunk_size = Unpacked/uncompressed size of each chunk, the workshop uses 128KB chunks.
+        level = zlib compression level.
+        workers = Number of chunks compressed in parallel, zlib releases the GIL so this uses a thread pool.
+        sidecar = Also write the dst.uncompressed_size file the workshop ships next to each archive.
+
+    Process:
+        1. Reserve room for the header and the compression index, the number of chunks is known from the size of the source.
+        2. Compress the source one chunk at a time across the workers, at most workers * 2 chunks are in flight and they are written in order.
+        3. Go back and write the header and the index now that the compressed sizes are known.
+
+    Returns the ArchiveInfo of the new archive.
+    '''
+
+    size_unpacked = os.path.getsize(src)
+    chunks = -(-size_unpacked // chunk_size)
+    index = array.array('q', [0] * (chunks * 2))
+
+    with open(src, 'rb') as f, open(dst, 'wb') as out:
+        out.write(b'\0' * (_HEADER.size + index.itemsize * len(index)))
+
+        window = max(1, workers) * 2
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pending = collections.deque()
+            for n in range(chunks):
+                data = f.read(chunk_size)
+                pending.append((n, len(data), executor.submit(zlib.compress, data, level)))
+
+                #Write finished chunks in order once the window is full, and everything after the last chunk
+                while len(pending) >= window or (pending and n == chunks - 1):
+                    i, uncompressed, future = pending.popleft()
+                    compressed_data = future.result()
+                    index[i * 2] = len(compressed_data)
+                    index[i * 2 + 1] = uncompressed
+                    out.write(compressed_data)
+
+        size_packed = sum(index[0::2])
+        out.seek(0)
+        out.write(_HEADER.pack(2653586369, chunk_size, size_packed, size_unpacked))
+        out.write(index.tobytes())
+
+    if sidecar:
+        with open(dst + '.uncompressed_size', 'w') as f:
+            f.write(str(size_unpacked))
+
+    logging.info("Archive has been packed.")
+    return ArchiveInfo(chunk_size, size_packed, size_unpacked, index)
+
+def unpack_many(jobs, workers=4, fail_fast=True, chunk_workers=1, cache=None, throttle=None, callback=None):
+    '''
+    Unpacks a batch of ARK's Steam Workshop *.z archives across a pool of worker threads.
+
+    Accepts one argument:
+        jobs = Iterable of (src, dst) pairs, or (src, dst, previous) to pass previous on to unpack
+
+    Optional arguments:
+        workers = Number of archives unpacked at the same time.
+        fail_fast = Stop handing out new archives after the first failure. When False every archive is attempted.
+        chunk_workers = Passed to unpack as workers, for batches containing large archives.
+        cache = ChunkCache shared by every archive of the batch.
+        throttle = Throttle shared by every archive of the batch.
+        callback = Called with the UnpackResult of each archive as soon as it is done, from the calling thread.
+
+    Returns:
+        A list of UnpackResult(src, dst, error, info) in the same order as jobs, error is None when the archive was extracted
+        and info is then its ArchiveInfo.
+        With fail_fast archives that were never started are left out of the list.
+    '''
+
+    jobs = list(jobs)
+    results = [None] * len(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(unpack, job[0], job[1], chunk_workers, False, cache, *job[2:], throttle=throttle): i for i, job in enumerate(jobs)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            src, dst = jobs[i][:2]
+            try:
+                results[i] = UnpackResult(src, dst, None, future.result())
+            except concurrent.futures.CancelledError:
+                continue
+            except Exception as e:
+                logging.error("Failed to unpack {}: {}".format(src, e))
+                results[i] = UnpackResult(src, dst, e)
+                if fail_fast:
+                    for pending in futures:
+                        pending.cancel()
+            if callback:
+                callback(results[i])
+
+    return [result for result in results if result is not None]
+
+def verify(src, deep=True):
+    '''
+    Checks the integrity of a *.z archive without writing any output.
+
+    Accepts one argument:
+        src = Source File/Archive
+
+    Optional arguments:
+        deep = Also decompress every chunk and verify its size against the index and header. When False only the header,
+               index and the chunk table fitting inside the file are checked.
+
+    Returns the ArchiveInfo of the archive, raises the same exceptions as unpack if it is corrupt.
+    '''
+
+    with open(src, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            _parse_archive(f.read())
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            info = _parse_archive(view)
+
+            end = info.data_offset + sum(info.index[0::2])
+            if end > len(view):
+                msg = "Archive is truncated. The index needs {} bytes but the archive is only {} bytes.".format(end, len(view))
                 logging.critical(msg)
                 raise CorruptUnpackException(msg)
-        else:
-            msg = "The signature and format version is incorrect. Signature was {} should be 2653586369.".format(sigver)
-            logging.critical(msg)
-            raise SignatureUnpackException(msg)
-
-    #Write the extracted data to disk
-    with open(dst, 'wb') as f:
-        f.write(data)
-    logging.info("Archive has been extracted.")
+
+            if deep:
+                read_data = 0
+                for offset, compressed, uncompressed in info.chunk_table:
+                    with view[offset:offset + compressed] as chunk:
+                        size = len(_inflate(chunk))
+                    read_data += 1
+                    _verify_chunk(size, uncompressed, info.chunk_size, read_data, len(info))
+
+    return info
+
+try:
+    set_backend()
+except (ImportError, ValueError) as e:
+    logging.critical("ARKIT_BACKEND is invalid, falling back to the fastest backend installed: {}".format(e))
+    set_backend(available_backends()[0])
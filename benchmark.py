@@ -0,0 +1,311 @@
+"""
+Benchmark the hot paths of the mod downloader against synthetic workshop mods.
+
+Everything runs offline.  A set of mods is generated with arkit.pack (.z archives plus valid mod.info and
+modmeta.info files) and served by a stub SteamCMD that copies them into the workshop content folder.  The stub
+relies on a #! line so it needs a POSIX host.
+
+Each phase is timed and the results, with MB/s and the peak RSS of each phase and of the whole run, are written as
+JSON.  Pass --compare with the JSON
+of an earlier revision to print the change per phase.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import arkit
+from Ark_Mod_Downloader import ArkModDownloader
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+
+
+STUB_STEAMCMD = '''#!{python}
+import os
+import shutil
+import sys
+
+fixtures = {fixtures!r}
+content = os.path.join(os.path.dirname(os.path.abspath(__file__)), "steamapps", "workshop", "content", "346110")
+
+
+def download(modid):
+    if os.path.isdir(os.path.join(fixtures, modid)):
+        shutil.rmtree(os.path.join(content, modid), ignore_errors=True)
+        shutil.copytree(os.path.join(fixtures, modid), os.path.join(content, modid))
+        print("Success. Downloaded item {{}} to \\"{{}}\\"".format(modid, os.path.join(content, modid)), flush=True)
+    else:
+        print("ERROR! Download item {{}} failed (File Not Found).".format(modid), flush=True)
+
+
+# Commands come as +arguments, without +quit they are read from the console like SteamCMD does
+args = sys.argv[1:]
+for i, arg in enumerate(args):
+    if arg == "+workshop_download_item":
+        download(args[i + 2])
+if "+quit" not in args:
+    for line in sys.stdin:
+        command = line.split()
+        if command[:1] == ["workshop_download_item"]:
+            download(command[2])
+        elif command[:1] == ["quit"]:
+            break
+'''
+
+
+def write_ue4_string(string_to_write, f):
+    raw = string_to_write.encode("utf-8") + b"\0"
+    f.write(struct.pack("i", len(raw)))
+    f.write(raw)
+
+
+def synthetic_data(rng, size):
+    """
+    Roughly as compressible as real assets: random runs mixed with repeated ones
+    :return: Bytes
+    """
+    data = bytearray()
+    while len(data) < size:
+        run = rng.randint(64, 4096)
+        if rng.random() < 0.4:
+            data += rng.randbytes(run)
+        else:
+            data += bytes([rng.randint(0, 255)]) * run
+    return bytes(data[:size])
+
+
+def generate_mod(root, modid, files, file_size, chunk_size, seed):
+    """
+    Write a synthetic workshop mod to root/modid/WindowsNoEditor
+    :return: Total unpacked bytes of the .z archives
+    """
+    rng = random.Random(seed)
+    mod_dir = os.path.join(root, modid, "WindowsNoEditor")
+    os.makedirs(os.path.join(mod_dir, "Assets"), exist_ok=True)
+
+    with open(os.path.join(mod_dir, "mod.info"), "wb") as f:
+        write_ue4_string("Benchmark Mod " + modid, f)
+        f.write(struct.pack("i", 1))
+        write_ue4_string("BenchmarkMap" + modid, f)
+
+    meta = [("ModType", "1"), ("Guid", "{:032x}".format(rng.getrandbits(128)))]
+    with open(os.path.join(mod_dir, "modmeta.info"), "wb") as f:
+        f.write(struct.pack("i", len(meta)))
+        for key, value in meta:
+            write_ue4_string(key, f)
+            write_ue4_string(value, f)
+
+    total = 0
+    for i in range(files):
+        raw = os.path.join(mod_dir, "Assets", "Asset{}.uasset".format(i))
+        with open(raw, "wb") as f:
+            f.write(synthetic_data(rng, file_size))
+        arkit.pack(raw, raw + ".z", chunk_size=chunk_size, sidecar=True)
+        os.remove(raw)
+        total += file_size
+    return total
+
+
+def peak_rss_kb():
+    """
+    Peak RSS of the whole process so far
+    :return: KB or None
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def rss_kb():
+    """
+    Current RSS of the process, read from /proc so it is only available on Linux
+    :return: KB or None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Timer():
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name, size=0):
+        """
+        Time a block, quietly, and record its throughput and its peak RSS.  ru_maxrss only knows the peak of the
+        whole process, so the RSS is sampled every 10ms while the block runs instead
+        """
+        peak = [rss_kb()]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.01) and peak[0] is not None:
+                peak[0] = max(peak[0], rss_kb() or 0)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield
+        finally:
+            seconds = time.perf_counter() - start
+            done.set()
+            sampler.join()
+        if peak[0] is not None:
+            peak[0] = max(peak[0], rss_kb() or 0)
+        self.phases[name] = {
+            "seconds": round(seconds, 4),
+            "bytes": size,
+            "mb_per_s": round(size / seconds / 1024 / 1024, 2) if size and seconds else None,
+            "peak_rss_kb": peak[0],
+        }
+        print("[+] {:<20} {:>9.3f}s {}".format(name, seconds, "{:.1f} MB/s".format(self.phases[name]["mb_per_s"]) if self.phases[name]["mb_per_s"] else ""))
+
+
+def run(args, work_dir):
+    fixtures = os.path.join(work_dir, "fixtures")
+    server = os.path.join(work_dir, "server")
+    steamcmd_dir = os.path.join(work_dir, "SteamCMD")
+    os.makedirs(os.path.join(server, "ShooterGame", "Content", "Mods"))
+    os.makedirs(steamcmd_dir)
+
+    print("[+] Generating {} Mods of {} x {} MB".format(args.mods, args.files, args.file_size))
+    modids = [str(900000000 + i) for i in range(args.mods)]
+    total = 0
+    for i, modid in enumerate(modids):
+        total += generate_mod(fixtures, modid, args.files, int(args.file_size * 1024 * 1024), args.chunk_size, args.seed + i)
+
+    steamcmd = os.path.join(steamcmd_dir, "steamcmd.exe")
+    with open(steamcmd, "w") as f:
+        f.write(STUB_STEAMCMD.format(python=sys.executable, fixtures=fixtures))
+    os.chmod(steamcmd, 0o755)
+
+    timer = Timer()
+
+    archives = []
+    for curdir, subdirs, files in os.walk(fixtures):
+        archives += [os.path.join(curdir, file) for file in files if file.endswith(".z")]
+    output = os.path.join(work_dir, "unpacked")
+    for workers in sorted({1, args.workers}):
+        with timer.phase("arkit.unpack[{}]".format(workers), total):
+            for archive in archives:
+                arkit.unpack(archive, output, workers=workers)
+    os.remove(output)
+
+    backends = None
+    if args.backends:
+        backends = arkit.benchmark_backends(archives[0] if args.backends is True else args.backends)
+        for name, mb_per_s in backends.items():
+            print("[+] {:<20} {:>9.1f} MB/s".format("inflate[" + name + "]", mb_per_s))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        downloader = ArkModDownloader(steamcmd_dir, None, server, False, None, workers=args.workers)
+
+    with timer.phase("download_mods"):
+        downloader.download_mods(modids)
+    with timer.phase("extract_mod", total):
+        for modid in modids:
+            downloader.extract_mod(modid)
+    with timer.phase("parse_base_info"):
+        for modid in modids:
+            downloader.parse_base_info(modid)
+    with timer.phase("parse_meta_data"):
+        for modid in modids:
+            downloader.parse_meta_data(modid)
+    with timer.phase("create_mod_file"):
+        for modid in modids:
+            downloader.create_mod_file(modid)
+    with timer.phase("move_mod", total):
+        for modid in modids:
+            downloader.move_mod(modid)
+    with timer.phase("move_mod_unchanged", total):
+        for modid in modids:
+            downloader.move_mod(modid)
+
+    return {
+        "revision": revision(),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "params": vars(args),
+        "total_bytes": total,
+        "phases": timer.phases,
+        "backends": backends,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    print("[+] Compared To {}".format(baseline.get("revision") or baseline_path))
+    for name, phase in results["phases"].items():
+        old = baseline.get("phases", {}).get(name)
+        if not old or not old["seconds"]:
+            continue
+        change = (phase["seconds"] - old["seconds"]) / old["seconds"] * 100
+        print("[{}] {:<20} {:>9.3f}s -> {:>9.3f}s ({:+.1f}%)".format("+" if change <= 0 else "x", name, old["seconds"], phase["seconds"], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ARK Mod Downloader against synthetic workshop mods")
+    parser.add_argument("--mods", default=3, type=int, dest="mods", help="Number of Mods To Generate")
+    parser.add_argument("--files", default=20, type=int, dest="files", help="Number of .z Files Per Mod")
+    parser.add_argument("--filesize", default=2.0, type=float, dest="file_size", help="Unpacked Size Of Each .z File In MB")
+    parser.add_argument("--chunksize", default=131072, type=int, dest="chunk_size", help="Unpacked Chunk Size Of The .z Files")
+    parser.add_argument("--workers", default=4, type=int, dest="workers", help="Workers Passed To The Downloader And arkit")
+    parser.add_argument("--seed", default=1, type=int, dest="seed", help="Seed For The Synthetic Data")
+    parser.add_argument("--output", default=None, dest="output", help="Write The Results As JSON To This File")
+    parser.add_argument("--compare", default=None, dest="compare", help="JSON Results Of An Earlier Run To Compare Against")
+    parser.add_argument("--backends", nargs="?", const=True, default=None, dest="backends", help="Also Compare The Decompression Backends On This .z File, Or A Generated One")
+    parser.add_argument("--keep", default=None, action="store_true", dest="keep", help="Keep The Generated Files")
+
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="ark_mod_benchmark_")
+    try:
+        results = run(args, work_dir)
+    finally:
+        if args.keep:
+            print("[+] Generated Files Kept In " + work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+        print("[+] Results Written To " + args.output)
+    else:
+        print(json.dumps(results, indent=1))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
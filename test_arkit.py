@@ -0,0 +1,158 @@
+"""
+Round trips and error paths of arkit.  Run with python -m pytest or python -m unittest.
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import arkit
+from benchmark import synthetic_data
+
+
+class ArkitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="arkit_test_")
+        # Several full chunks and a partial one at the end
+        self.data = synthetic_data(random.Random(1), 5 * 65536 + 1234)
+        self.src = self.path("asset.uasset")
+        with open(self.src, "wb") as f:
+            f.write(self.data)
+        self.archive = self.path("asset.uasset.z")
+        arkit.pack(self.src, self.archive, chunk_size=65536)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def damage(self, offset, data):
+        with open(self.archive, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+
+
+class RoundTripTest(ArkitTestCase):
+
+    def test_serial(self):
+        arkit.unpack(self.archive, self.path("out"))
+        self.assertEqual(self.read(self.path("out")), self.data)
+
+    def test_threads(self):
+        arkit.unpack(self.archive, self.path("out"), workers=4)
+        self.assertEqual(self.read(self.path("out")), self.data)
+
+    def test_processes(self):
+        arkit.unpack(self.archive, self.path("out"), workers=2, processes=True)
+        self.assertEqual(self.read(self.path("out")), self.data)
+
+    def test_backends(self):
+        for backend in arkit.available_backends():
+            with self.subTest(backend=backend):
+                arkit.unpack(self.archive, self.path(backend), workers=2, backend=backend)
+                self.assertEqual(self.read(self.path(backend)), self.data)
+
+    def test_empty_file(self):
+        open(self.src, "wb").close()
+        arkit.pack(self.src, self.archive)
+        arkit.unpack(self.archive, self.path("out"))
+        self.assertEqual(self.read(self.path("out")), b"")
+
+    def test_sidecar(self):
+        arkit.pack(self.src, self.archive, sidecar=True)
+        self.assertEqual(self.read(self.archive + ".uncompressed_size"), str(len(self.data)).encode())
+
+    def test_verify(self):
+        info = arkit.verify(self.archive)
+        self.assertEqual(info.size_unpacked, len(self.data))
+        self.assertEqual(len(info), 6)
+
+    def test_unpack_many(self):
+        jobs = [(self.archive, self.path("out{}".format(i))) for i in range(3)]
+        results = arkit.unpack_many(jobs, workers=2)
+        self.assertEqual([result.error for result in results], [None] * 3)
+        for src, dst in jobs:
+            self.assertEqual(self.read(dst), self.data)
+
+    def test_chunk_cache_reuses_previous_output(self):
+        cache = arkit.ChunkCache(self.path("cache"), 0)
+        arkit.unpack(self.archive, self.path("out"), cache=cache)
+        arkit.unpack(self.archive, self.path("out"), cache=cache)
+        self.assertEqual(self.read(self.path("out")), self.data)
+        self.assertEqual(cache.reused, 6)
+
+    def test_chunk_cache_rejects_changed_previous_output(self):
+        cache = arkit.ChunkCache(self.path("cache"), 0)
+        arkit.unpack(self.archive, self.path("out"), cache=cache)
+        # Same size and mtime, so the layout still matches, but one chunk differs
+        stat = os.stat(self.path("out"))
+        with open(self.path("out"), "r+b") as f:
+            f.seek(70000)
+            f.write(b"\0" * 16)
+        os.utime(self.path("out"), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        arkit.unpack(self.archive, self.path("new"), cache=cache, previous=self.path("out"))
+        self.assertEqual(self.read(self.path("new")), self.data)
+        self.assertEqual(cache.reused, 5)
+
+
+class CorruptArchiveTest(ArkitTestCase):
+
+    def test_bad_signature(self):
+        self.damage(0, b"\0" * 8)
+        with self.assertRaises(arkit.SignatureUnpackException):
+            arkit.unpack(self.archive, self.path("out"))
+        with self.assertRaises(arkit.SignatureUnpackException):
+            arkit.verify(self.archive)
+
+    def test_too_small_for_header(self):
+        with open(self.archive, "wb") as f:
+            f.write(b"\0" * 10)
+        with self.assertRaises(arkit.CorruptUnpackException):
+            arkit.unpack(self.archive, self.path("out"))
+        with self.assertRaises(arkit.CorruptUnpackException):
+            arkit.verify(self.archive)
+
+    def test_truncated(self):
+        with open(self.archive, "r+b") as f:
+            f.truncate(os.path.getsize(self.archive) - 100)
+        for workers in (1, 4):
+            with self.subTest(workers=workers), self.assertRaises(arkit.CorruptUnpackException):
+                arkit.unpack(self.archive, self.path("out"), workers=workers)
+        with self.assertRaises(arkit.CorruptUnpackException):
+            arkit.verify(self.archive, deep=False)
+
+    def test_corrupt_chunk(self):
+        # Overwrite the zlib header of the second chunk
+        offset, compressed, uncompressed = list(arkit.read_info(self.archive).chunk_table)[1]
+        self.damage(offset, b"\0\0")
+        for backend in arkit.available_backends():
+            for workers in (1, 4):
+                with self.subTest(backend=backend, workers=workers):
+                    with self.assertRaises(arkit.CorruptUnpackException):
+                        arkit.unpack(self.archive, self.path("out"), workers=workers, backend=backend)
+                    # The partly written output is removed
+                    self.assertFalse(os.path.exists(self.path("out")))
+        with self.assertRaises(arkit.CorruptUnpackException):
+            arkit.verify(self.archive)
+
+    def test_unpack_many_collects_errors(self):
+        self.damage(0, b"\0" * 8)
+        good = self.path("good.z")
+        arkit.pack(self.src, good)
+        jobs = [(self.archive, self.path("bad")), (good, self.path("good"))]
+        results = arkit.unpack_many(jobs, workers=1, fail_fast=False)
+        self.assertIsInstance(results[0].error, arkit.SignatureUnpackException)
+        self.assertIsNone(results[1].error)
+        self.assertEqual(self.read(self.path("good")), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,327 @@
+"""
+The install pipeline and daemon rounds against the stub SteamCMD and synthetic mods of benchmark.py, and the .acf
+(VDF) round trip.
+Run with python -m pytest or python -m unittest.
+"""
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+import arkit
+import Ark_Mod_Downloader
+from Ark_Mod_Downloader import ArkModDownloader, SteamCmdSession, dump_vdf, parse_vdf, scan_tree, swap_into_place, sync_tree
+from benchmark import STUB_STEAMCMD, generate_mod
+
+
+@unittest.skipIf(os.name == "nt", "The stub SteamCMD relies on a #! line")
+class StubSteamCmdTestCase(unittest.TestCase):
+
+    servers = ("server",)
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="ark_mod_test_")
+        self.fixtures = os.path.join(self.work_dir, "fixtures")
+        self.steamcmd_dir = os.path.join(self.work_dir, "SteamCMD")
+        self.server_dirs = [os.path.join(self.work_dir, server) for server in self.servers]
+        for server in self.server_dirs:
+            os.makedirs(os.path.join(server, "ShooterGame", "Content", "Mods"))
+        os.makedirs(self.steamcmd_dir)
+
+        self.modid = "900000001"
+        generate_mod(self.fixtures, self.modid, 3, 200000, 65536, 1)
+
+        self.steamcmd = os.path.join(self.steamcmd_dir, "steamcmd.exe")
+        with open(self.steamcmd, "w") as f:
+            f.write(STUB_STEAMCMD.format(python=sys.executable, fixtures=self.fixtures))
+        os.chmod(self.steamcmd, 0o755)
+
+        # No retries, a failed item would otherwise wait for the backoff
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.downloader = ArkModDownloader(self.steamcmd_dir, None, self.server_dirs, False, None, workers=2, retries=0)
+        self.server = self.server_dirs[0]
+        self.mods_dir = os.path.join(self.server, "ShooterGame", "Content", "Mods")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def install(self, *modids):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.downloader.install_mods(list(modids))
+
+    def assertInstalled(self, modid, server=None):
+        mods_dir = os.path.join(server or self.server, "ShooterGame", "Content", "Mods")
+        fixture = os.path.join(self.fixtures, modid, "WindowsNoEditor", "Assets")
+        for file in os.listdir(fixture):
+            if file.endswith(".z"):
+                arkit.unpack(os.path.join(fixture, file), os.path.join(self.work_dir, "expected"))
+                with open(os.path.join(self.work_dir, "expected"), "rb") as expected, \
+                        open(os.path.join(mods_dir, modid, "Assets", file[:-2]), "rb") as installed:
+                    self.assertEqual(installed.read(), expected.read())
+        self.assertTrue(os.path.isfile(os.path.join(mods_dir, modid, ".mod")))
+        self.assertTrue(os.path.isfile(self.downloader.manifest_path(modid, server)))
+
+
+class PipelineTest(StubSteamCmdTestCase):
+
+    def test_install(self):
+        results = self.install(self.modid)
+        self.assertTrue(results[self.modid]["install"]["ok"])
+        self.assertInstalled(self.modid)
+
+    def test_install_large_archives(self):
+        # Every .z file counts as large, so each is unpacked with all workers on its chunks
+        self.downloader.large_archive = 0
+        results = self.install(self.modid)
+        self.assertTrue(results[self.modid]["install"]["ok"])
+        self.assertInstalled(self.modid)
+
+    def test_skip_unchanged(self):
+        self.install(self.modid)
+        results = self.install(self.modid)
+        self.assertTrue(results[self.modid]["check"]["skipped"])
+        self.assertNotIn("extract", results[self.modid])
+        self.assertInstalled(self.modid)
+
+    def test_reinstall_reads_only_changed_files(self):
+        self.install(self.modid)
+        # Pretend the download changed so the unchanged content goes through the whole install again
+        manifest = self.downloader.load_manifest(self.modid)
+        manifest["source"] = {}
+        with open(self.downloader.manifest_path(self.modid), "w") as f:
+            json.dump(manifest, f)
+
+        with mock.patch.object(Ark_Mod_Downloader, "hash_file", wraps=Ark_Mod_Downloader.hash_file) as hashed:
+            results = self.install(self.modid)
+        self.assertTrue(results[self.modid]["install"]["ok"])
+        # Neither sync_tree nor the new manifest read the installed files again, only the .mod file is checked
+        read = [call[0][0] for call in hashed.call_args_list if call[0][0].startswith(self.mods_dir)]
+        self.assertEqual(read, [os.path.join(self.mods_dir, self.modid, ".mod")])
+        self.assertInstalled(self.modid)
+
+    def test_resume(self):
+        # An install killed after its extraction, the journal records the finished stages
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(self.downloader.download_mods([self.modid])[self.modid])
+            self.downloader.journal_stage(self.modid, "download")
+            self.assertTrue(self.downloader.check_mod(self.modid))
+            self.assertTrue(self.downloader.extract_mod(self.modid))
+
+        # Resuming must not download again, which would fail now
+        shutil.rmtree(os.path.join(self.fixtures, self.modid))
+        results = self.install(self.modid)
+        self.assertTrue(results[self.modid]["install"]["ok"])
+        self.assertIsNone(self.downloader.load_journal(self.modid))
+
+    def test_download_metrics_per_mod(self):
+        generate_mod(self.fixtures, "900000002", 1, 100000, 65536, 2)
+        self.downloader.download_batch_size = 2
+        self.install(self.modid, "900000002", "900000003")
+        events = [event for event in self.downloader.metrics.events if event["phase"] == "download"]
+        self.assertEqual([event["mod"] for event in events], [self.modid, "900000002", "900000003"])
+        self.assertEqual([event["outcome"] for event in events], ["ok", "ok", "failed"])
+        self.assertTrue(all(event["files"] for event in events[:2]))
+
+    def test_interrupted_swap_is_restored(self):
+        self.install(self.modid)
+        # Killed between the two renames of swap_into_place
+        os.rename(os.path.join(self.mods_dir, self.modid), os.path.join(self.mods_dir, "." + self.modid + ".old"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            ArkModDownloader(self.steamcmd_dir, None, self.server_dirs, False, None)
+        self.assertInstalled(self.modid)
+        self.assertEqual(os.listdir(self.mods_dir), [self.modid])
+
+    def test_failed_download(self):
+        missing = "900000002"
+        # A content folder left over from an earlier download does not count as downloaded
+        os.makedirs(os.path.join(self.downloader.temp_mod_path, missing, "WindowsNoEditor"))
+        results = self.install(self.modid, missing)
+        self.assertFalse(results[missing]["download"]["ok"])
+        self.assertNotIn("install", results[missing])
+        self.assertFalse(os.path.exists(os.path.join(self.mods_dir, missing)))
+        self.assertTrue(results[self.modid]["install"]["ok"])
+
+
+class RepairTest(StubSteamCmdTestCase):
+
+    servers = ("server1", "server2")
+
+    def verify(self, repair=False):
+        with contextlib.redirect_stdout(io.StringIO()):
+            downloader = ArkModDownloader(self.steamcmd_dir, None, self.server_dirs, False, None, verify=True,
+                                          repair=repair, retries=0)
+            return downloader.verify_mods()
+
+    def asset(self, server):
+        return os.path.join(server, "ShooterGame", "Content", "Mods", self.modid, "Assets", "Asset0.uasset")
+
+    def test_repair_on_every_server(self):
+        self.install(self.modid)
+        # Written in place, so the store object and both servers' hard links to it are damaged
+        with open(self.asset(self.server_dirs[1]), "r+b") as f:
+            f.write(b"\0" * 16)
+        corrupt, corrupt_cache = self.verify()
+        self.assertEqual(list(corrupt[self.modid]), self.server_dirs)
+
+        self.verify(repair=True)
+        self.assertEqual(self.verify(), (OrderedDict(), []))
+        for server in self.server_dirs:
+            self.assertInstalled(self.modid, server)
+
+    def test_repair_only_where_corrupt(self):
+        self.downloader.mod_targets = {self.modid: [self.server_dirs[1]]}
+        self.install(self.modid)
+        os.remove(self.asset(self.server_dirs[1]))
+        corrupt, corrupt_cache = self.verify()
+        self.assertEqual(list(corrupt[self.modid]), [self.server_dirs[1]])
+
+        self.verify(repair=True)
+        self.assertEqual(self.verify(), (OrderedDict(), []))
+        self.assertInstalled(self.modid, self.server_dirs[1])
+        self.assertFalse(os.path.exists(os.path.join(self.server_dirs[0], "ShooterGame", "Content", "Mods", self.modid)))
+
+
+class DaemonTest(StubSteamCmdTestCase):
+
+    servers = ("server1", "server2")
+
+    def setUp(self):
+        super().setUp()
+        generate_mod(self.fixtures, "900000002", 2, 100000, 65536, 2)
+        self.downloader.clean_mods = True
+        self.downloader.sessions = [SteamCmdSession(self.steamcmd, retries=0)]
+
+    def tearDown(self):
+        for session in self.downloader.sessions:
+            session.close()
+        super().tearDown()
+
+    def run_round(self, *jobs):
+        batch = [self.downloader.submit_job(*job) for job in jobs]
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.downloader.run_round(batch)
+        return batch
+
+    def installed(self, server):
+        return sorted(os.listdir(os.path.join(server, "ShooterGame", "Content", "Mods")))
+
+    def test_jobs_per_server(self):
+        first, second = self.run_round(([self.modid], False, [self.server_dirs[0]]),
+                                       ([self.modid, "900000002"], False, [self.server_dirs[1]]))
+        self.assertEqual((first["status"], second["status"]), ("done", "done"))
+        self.assertEqual(self.installed(self.server_dirs[0]), [self.modid])
+        self.assertEqual(self.installed(self.server_dirs[1]), [self.modid, "900000002"])
+        self.assertInstalled(self.modid, self.server_dirs[0])
+        self.assertInstalled("900000002", self.server_dirs[1])
+
+    def test_update_per_server(self):
+        self.run_round(([self.modid], False, [self.server_dirs[0]]), (["900000002"], False, [self.server_dirs[1]]))
+        update, = self.run_round(([], True))
+        self.assertEqual(update["status"], "done")
+        self.assertEqual(sorted(update["modids"]), [self.modid, "900000002"])
+        # Every server only gets its own mods back
+        self.assertEqual(self.installed(self.server_dirs[0]), [self.modid])
+        self.assertEqual(self.installed(self.server_dirs[1]), ["900000002"])
+
+    def test_failed_download(self):
+        job, = self.run_round((["900000003"], False))
+        self.assertEqual(job["status"], "failed")
+        self.assertFalse(job["results"]["900000003"]["download"]["ok"])
+
+    def test_hung_session_times_out(self):
+        hung = os.path.join(self.steamcmd_dir, "hung.exe")
+        with open(hung, "w") as f:
+            f.write("#!{}\nimport sys, time\nfor line in sys.stdin:\n    time.sleep(60)\n".format(sys.executable))
+        os.chmod(hung, 0o755)
+
+        session = SteamCmdSession(hung, item_timeout=1, retries=1, backoff=0)
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            downloaded = asyncio.run(session.download([self.modid]))
+        session.close()
+        self.assertEqual(downloaded, {self.modid: False})
+        # One timeout per attempt, not the default of half an hour
+        self.assertLess(time.time() - start, 10)
+
+    def test_unknown_server(self):
+        self.assertEqual(self.downloader.find_servers([self.server_dirs[1], self.work_dir]), [self.server_dirs[1], None])
+
+
+class SyncTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="ark_sync_test_")
+        self.source = os.path.join(self.work_dir, "source")
+        self.output = os.path.join(self.work_dir, "output")
+        for name in ("a", "b", "c"):
+            self.write(os.path.join(self.output, name), name * 1000)
+            self.write(os.path.join(self.source, name), name * 1000)
+        self.write(os.path.join(self.source, "b"), "B" * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+
+    def test_only_source_is_hashed(self):
+        installed = scan_tree(self.output)
+        with mock.patch.object(Ark_Mod_Downloader, "hash_file", wraps=Ark_Mod_Downloader.hash_file) as hashed:
+            copied, unchanged, deleted, copied_bytes = sync_tree(self.source, self.output, installed=installed)
+        self.assertEqual((copied, unchanged, deleted), (1, 2, 0))
+        self.assertTrue(all(call[0][0].startswith(self.source) for call in hashed.call_args_list))
+        with open(os.path.join(self.output, "b")) as f:
+            self.assertEqual(f.read(), "B" * 1000)
+
+    def test_swap_after_interrupted_swap(self):
+        os.rename(self.output, os.path.join(self.work_dir, ".output.old"))
+        staging = os.path.join(self.work_dir, ".output.staging")
+        shutil.copytree(self.source, staging)
+        swap_into_place(staging, self.output)
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ["output", "source"])
+        self.assertEqual(sorted(os.listdir(self.output)), ["a", "b", "c"])
+
+
+class VdfTest(unittest.TestCase):
+
+    ACF = '''"AppWorkshop"
+{
+	"appid"		"346110"
+	"WorkshopItemsInstalled"
+	{
+		"900000001"
+		{
+			"size"		"1234"
+			"timeupdated"		"1600000000"
+		}
+	}
+	"WorkshopItemDetails"
+	{
+	}
+	"path"		"C:\\\\steamcmd\\\\steamapps"
+}'''
+
+    def test_round_trip(self):
+        parsed = parse_vdf(self.ACF)
+        self.assertEqual(parsed["AppWorkshop"]["WorkshopItemsInstalled"]["900000001"]["size"], "1234")
+        self.assertEqual(parsed["AppWorkshop"]["WorkshopItemDetails"], {})
+        self.assertEqual(parse_vdf(dump_vdf(parsed)), parsed)
+
+    def test_escaped_quotes(self):
+        parsed = parse_vdf('"key"\t\t"a \\"quoted\\" value"')
+        self.assertEqual(parsed["key"], 'a \\"quoted\\" value')
+        self.assertEqual(parse_vdf(dump_vdf(parsed)), parsed)
+
+
+if __name__ == '__main__':
+    unittest.main()